@@ -111,3 +111,6 @@ SIMPLE_MESSAGING_COUNTRY_CODE = 'US'
 SIMPLE_MESSAGING_SECRET_KEY = 'CHANGEME' # nosec
 
 SITE_URL = 'https://' + ALLOWED_HOSTS[0]
+
+SIMPLE_MESSAGING_DIALOG_LOCK_BACKEND = 'process'
+SIMPLE_MESSAGING_DIALOG_SEND_DISPATCH = 'immediate'
@@ -6,7 +6,7 @@ from django.db.models import Q
 
 from django_dialog_engine.models import DialogScript
 
-from .models import DialogSession, DialogVariable, DialogTemplateVariable, DialogAlert, LaunchKeyword
+from .models import DialogSession, DialogVariable, DialogTemplateVariable, DialogAlert, LaunchKeyword, MediaCacheEntry, PendingMessageMedia, generate_lookup_hash
 
 @admin.register(DialogSession)
 class DialogSessionAdmin(admin.ModelAdmin):
@@ -15,7 +15,7 @@ class DialogSessionAdmin(admin.ModelAdmin):
     else:
         list_display = ('destination', 'dialog', 'transmission_channel', 'started', 'last_updated', 'finished')
 
-    readonly_fields = ['dialog']
+    readonly_fields = ['dialog', 'lookup_hash', 'latest_variables', 'last_variable_update']
 
     list_filter = ('started', 'last_updated', 'finished', 'transmission_channel',)
 
@@ -27,9 +27,22 @@ class DialogSessionAdmin(admin.ModelAdmin):
         if search_term is None or search_term == '':
             return queryset, may_have_duplicates
 
-        for session in original_query_set:
+        queryset = queryset | self.model.objects.filter(lookup_hash=generate_lookup_hash(search_term))
+
+        seen_hashes = set()
+
+        for session in original_query_set.only('destination', 'lookup_hash'):
+            if session.lookup_hash is not None:
+                if session.lookup_hash in seen_hashes:
+                    continue # Destination already checked
+
+                seen_hashes.add(session.lookup_hash)
+
             if search_term in session.current_destination():
-                queryset = queryset | self.model.objects.filter(destination=session.destination)
+                if session.lookup_hash is not None:
+                    queryset = queryset | self.model.objects.filter(lookup_hash=session.lookup_hash)
+                else:
+                    queryset = queryset | self.model.objects.filter(destination=session.destination)
 
         return queryset, may_have_duplicates
 
@@ -87,6 +100,20 @@ class LaunchKeywordAdmin(admin.ModelAdmin):
 
         return form
 
-    list_display = ('keyword', 'dialog_script', 'case_sensitive', 'priority',)
+    list_display = ('keyword', 'dialog_script', 'match_mode', 'case_sensitive', 'priority',)
     search_fields = ('keyword', 'dialog_script',)
-    list_filter = ('case_sensitive',)
+    list_filter = ('match_mode', 'case_sensitive',)
+
+@admin.register(MediaCacheEntry)
+class MediaCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ('url', 'content_type', 'size', 'fetched', 'last_validated', 'last_used',)
+    search_fields = ('url', 'content_hash',)
+    readonly_fields = ('url_hash',)
+    list_filter = ('fetched', 'last_validated', 'last_used', 'content_type',)
+
+@admin.register(PendingMessageMedia)
+class PendingMessageMediaAdmin(admin.ModelAdmin):
+    list_display = ('message', 'media_url', 'send_date', 'added', 'claimed', 'attempts', 'ready',)
+    search_fields = ('media_url', 'last_error',)
+    list_filter = ('added', 'claimed', 'send_date', 'ready',)
+    readonly_fields = ['message', 'lookup_hash']
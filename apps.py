@@ -5,3 +5,11 @@ class SimpleMessagingDialogSupportConfig(AppConfig):
     name = 'simple_messaging_dialog_support'
     verbose_name = 'Simple SMS Messaging: Dialog Support'
     default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from .hooks import build_hook_registry # pylint: disable=import-outside-toplevel
+        from . import keywords # pylint: disable=import-outside-toplevel, unused-import
+        from . import switchboard # pylint: disable=import-outside-toplevel, unused-import
+        from . import template_variables # pylint: disable=import-outside-toplevel, unused-import
+
+        build_hook_registry()
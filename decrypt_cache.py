@@ -0,0 +1,87 @@
+# pylint: disable=line-too-long
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+
+from simple_messaging.models import decrypt_value
+
+DECRYPT_CACHE = OrderedDict()
+DECRYPT_CACHE_LOCK = threading.Lock()
+
+DECRYPT_CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+}
+
+def decrypt_cache_size():
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_DECRYPT_CACHE_SIZE', 10000)
+
+def decrypt_cache_ttl():
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_DECRYPT_CACHE_TTL', 3600)
+
+def cached_decrypt_value(encrypted_value):
+    max_size = decrypt_cache_size()
+
+    if max_size <= 0:
+        return decrypt_value(encrypted_value)
+
+    ttl = decrypt_cache_ttl()
+
+    now = time.monotonic()
+
+    with DECRYPT_CACHE_LOCK:
+        cached = DECRYPT_CACHE.get(encrypted_value, None)
+
+        if cached is not None and (ttl is None or (now - cached[1]) < ttl):
+            DECRYPT_CACHE.move_to_end(encrypted_value)
+
+            DECRYPT_CACHE_STATS['hits'] += 1
+
+            return cached[0]
+
+        DECRYPT_CACHE_STATS['misses'] += 1
+
+    decrypted = decrypt_value(encrypted_value)
+
+    with DECRYPT_CACHE_LOCK:
+        DECRYPT_CACHE[encrypted_value] = (decrypted, now,)
+        DECRYPT_CACHE.move_to_end(encrypted_value)
+
+        while len(DECRYPT_CACHE) > max_size:
+            DECRYPT_CACHE.popitem(last=False)
+
+    return decrypted
+
+def prime_decrypt_cache(encrypted_value, decrypted):
+    max_size = decrypt_cache_size()
+
+    if max_size <= 0:
+        return
+
+    with DECRYPT_CACHE_LOCK:
+        DECRYPT_CACHE[encrypted_value] = (decrypted, time.monotonic(),)
+        DECRYPT_CACHE.move_to_end(encrypted_value)
+
+        while len(DECRYPT_CACHE) > max_size:
+            DECRYPT_CACHE.popitem(last=False)
+
+def decrypt_cache_stats():
+    with DECRYPT_CACHE_LOCK:
+        stats = dict(DECRYPT_CACHE_STATS)
+
+        stats['size'] = len(DECRYPT_CACHE)
+
+    stats['max_size'] = decrypt_cache_size()
+
+    return stats
+
+def clear_decrypt_cache():
+    with DECRYPT_CACHE_LOCK:
+        DECRYPT_CACHE.clear()
+
+        DECRYPT_CACHE_STATS['hits'] = 0
+        DECRYPT_CACHE_STATS['misses'] = 0
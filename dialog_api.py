@@ -12,6 +12,7 @@ from django.utils import timezone
 from simple_messaging.models import OutgoingMessage
 
 from .models import DialogVariable, DialogSession
+from .switchboard import default_channel
 
 def store_value(sender, dialog_key, key, value):
     value_obj = {
@@ -22,18 +23,13 @@ def store_value(sender, dialog_key, key, value):
         if value.get('value', None) is not None:
             value_obj = value
 
-    variable = DialogVariable.objects.create(sender=sender, dialog_key=dialog_key, key=key, value='json:%s' % json.dumps(value_obj), date_set=timezone.now())
-    variable.encrypt_sender()
+    DialogVariable.objects.create_encrypted(sender=sender, dialog_key=dialog_key, key=key, value='json:%s' % json.dumps(value_obj), date_set=timezone.now())
 
 def update_value(sender, dialog_key, key, value, operation, replacement): # pylint: disable=too-many-arguments, too-many-locals, too-many-branches, too-many-statements
     last_variable = None
 
     if (operation in ('clear-list', 'set',)) is False:
-        for variable in DialogVariable.objects.filter(dialog_key=dialog_key, key=key).order_by('-date_set'):
-            if variable.current_sender() == sender:
-                last_variable = variable
-
-                break
+        last_variable = DialogVariable.objects.latest_for_sender(sender, dialog_key, key)
 
     if operation == 'clear-list':
         store_value(sender, dialog_key, key, [])
@@ -159,30 +155,16 @@ def dialog_builder_cards():
     ]
 
 def launch_dialog_script(identifier, destination, dialog_options):
-    for session in DialogSession.objects.filter(finished=None):
-        if session.current_destination() == destination:
-            session.finished = timezone.now()
-            session.save()
-
-            session.dialog.finish('user_cancelled')
+    DialogSession.objects.cancel_for_destination(destination, 'user_cancelled')
 
     transmission_metadata = {}
 
     # TODO: Verify message channel picked up
 
-    try:
-        from simple_messaging_switchboard import Channel # pylint: disable=import-outside-toplevel
-
-        channel = Channel.objects.filter(is_enabled=True, is_default=True).first()
-
-        channel_name = None
-
-        if channel is not None:
-            channel_name = channel.identifier
+    channel_name = default_channel(require_enabled=True)
 
-            transmission_metadata['message_channel'] = channel_name
-    except ImportError:
-        pass
+    if channel_name is not None:
+        transmission_metadata['message_channel'] = channel_name
 
     # TODO: Normalize destination format IF a phone number.
 
@@ -0,0 +1,85 @@
+# pylint: disable=line-too-long
+
+import logging
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+
+SEND_DISPATCH_IMMEDIATE = 'immediate'
+SEND_DISPATCH_THREAD = 'thread'
+SEND_DISPATCH_DEFERRED = 'deferred'
+
+FLUSH_LOCK = threading.Lock()
+
+FLUSH_STATE = {
+    'pending': False,
+    'running': False,
+}
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+def send_dispatch_mode():
+    # Thread and deferred dispatch are opt-in - by default pending messages are sent once the transaction commits.
+
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_SEND_DISPATCH', SEND_DISPATCH_IMMEDIATE)
+
+def send_pending_messages():
+    try:
+        call_command('simple_messaging_send_pending_messages', _qs_context=False)
+    except: # pylint: disable=bare-except
+        logger.error('Error encountered with command %s:', 'simple_messaging_send_pending_messages')
+        logger.error(traceback.format_exc())
+
+def run_flusher():
+    flush_delay = getattr(settings, 'SIMPLE_MESSAGING_DIALOG_SEND_FLUSH_DELAY', 0.25)
+
+    try:
+        while True:
+            if flush_delay > 0:
+                time.sleep(flush_delay) # Let bursts of requests pile up behind a single pass
+
+            with FLUSH_LOCK:
+                if FLUSH_STATE['pending'] is False:
+                    FLUSH_STATE['running'] = False
+
+                    return
+
+                FLUSH_STATE['pending'] = False
+
+            send_pending_messages()
+    except: # pylint: disable=bare-except
+        with FLUSH_LOCK:
+            FLUSH_STATE['running'] = False
+
+        logger.error(traceback.format_exc())
+    finally:
+        connection.close()
+
+def start_flusher():
+    with FLUSH_LOCK:
+        FLUSH_STATE['pending'] = True
+
+        if FLUSH_STATE['running']:
+            return # Running flusher will pick up the new work
+
+        FLUSH_STATE['running'] = True
+
+    flusher = threading.Thread(target=run_flusher, name='simple_messaging_dialog_support_flusher')
+    flusher.start()
+
+def request_send_flush():
+    mode = send_dispatch_mode()
+
+    if mode == SEND_DISPATCH_DEFERRED:
+        return # Left to the scheduled simple_messaging_send_pending_messages task
+
+    if mode == SEND_DISPATCH_IMMEDIATE:
+        transaction.on_commit(send_pending_messages)
+    elif mode == SEND_DISPATCH_THREAD:
+        transaction.on_commit(start_flusher)
+    else:
+        raise ValueError('Unknown SIMPLE_MESSAGING_DIALOG_SEND_DISPATCH: %s' % mode)
@@ -0,0 +1,152 @@
+# pylint: disable=line-too-long
+
+import csv
+import gzip
+import io
+import json
+import logging
+import lzma
+import shutil
+
+from django.conf import settings
+
+from simple_data_export.utils import UnicodeWriter # pylint: disable=import-error
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None # pylint: disable=invalid-name
+
+EXPORT_FORMAT_TSV = 'tsv'
+EXPORT_FORMAT_TSV_GZIP = 'tsv.gz'
+EXPORT_FORMAT_TSV_LZMA = 'tsv.xz'
+EXPORT_FORMAT_PARQUET = 'parquet'
+EXPORT_FORMAT_ARROW = 'arrow'
+EXPORT_FORMAT_JSONL = 'jsonl'
+
+EXPORT_FORMAT_EXTENSIONS = {
+    EXPORT_FORMAT_TSV: '.txt',
+    EXPORT_FORMAT_TSV_GZIP: '.txt.gz',
+    EXPORT_FORMAT_TSV_LZMA: '.txt.xz',
+    EXPORT_FORMAT_PARQUET: '.parquet',
+    EXPORT_FORMAT_ARROW: '.arrow',
+    EXPORT_FORMAT_JSONL: '.jsonl',
+}
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+def export_format_option(custom_parameters=None):
+    export_format = getattr(settings, 'SIMPLE_MESSAGING_DIALOG_EXPORT_FORMAT', EXPORT_FORMAT_TSV)
+
+    if isinstance(custom_parameters, dict):
+        export_format = custom_parameters.get('dialog_export_format', export_format)
+
+    if (export_format in EXPORT_FORMAT_EXTENSIONS) is False:
+        raise ValueError('Unknown dialog export format: %s' % export_format)
+
+    if export_format in (EXPORT_FORMAT_PARQUET, EXPORT_FORMAT_ARROW,) and pyarrow is None:
+        logger.warning('pyarrow is not installed - writing %s export as JSON Lines instead.', export_format)
+
+        export_format = EXPORT_FORMAT_JSONL
+
+    return export_format
+
+def export_chunk_rows():
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_EXPORT_CHUNK_ROWS', 10000)
+
+class DelimitedExportWriter():
+    def __init__(self, outfile, columns):
+        self.outfile = outfile
+        self.writer = UnicodeWriter(outfile, delimiter='\t')
+
+        self.writer.writerow(columns)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def append_partial(self, partial_path):
+        self.outfile.flush()
+
+        with io.open(partial_path, 'rb') as partial_file:
+            shutil.copyfileobj(partial_file, self.outfile)
+
+    def close(self):
+        self.outfile.close()
+
+class ChunkedExportWriter():
+    def __init__(self, columns, write_chunk, finish):
+        self.columns = columns
+        self.rows = []
+
+        self.write_chunk = write_chunk # Called with each full chunk of rows
+        self.finish = finish
+
+    def writerow(self, row):
+        self.rows.append(row)
+
+        if len(self.rows) >= export_chunk_rows():
+            self.write_chunk(self.rows)
+
+            self.rows = []
+
+    def append_partial(self, partial_path):
+        with io.open(partial_path, 'r', encoding='utf-8', newline='') as partial_file:
+            for row in csv.reader(partial_file, delimiter='\t'):
+                self.writerow(row)
+
+    def close(self):
+        if self.rows:
+            self.write_chunk(self.rows)
+
+            self.rows = []
+
+        self.finish()
+
+class JsonLinesExportWriter(ChunkedExportWriter):
+    def __init__(self, filename, columns):
+        self.outfile = io.open(filename, 'w', encoding='utf-8') # pylint: disable=consider-using-with
+
+        super(JsonLinesExportWriter, self).__init__(columns, self.write_lines, self.outfile.close) # pylint: disable=super-with-arguments
+
+    def write_lines(self, rows):
+        self.outfile.writelines('%s\n' % json.dumps(dict(zip(self.columns, row))) for row in rows)
+
+class ArrowExportWriter(ChunkedExportWriter):
+    def __init__(self, filename, columns, export_format):
+        self.schema = pyarrow.schema([(column, pyarrow.string(),) for column in columns])
+
+        if export_format == EXPORT_FORMAT_PARQUET:
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(filename, self.schema)
+
+        super(ArrowExportWriter, self).__init__(columns, self.write_table, self.writer.close) # pylint: disable=super-with-arguments
+
+    def write_table(self, rows):
+        arrays = []
+
+        for index in range(0, len(self.columns)):
+            values = [(None if row[index] is None else str(row[index])) for row in rows]
+
+            arrays.append(pyarrow.array(values, type=pyarrow.string()))
+
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+def open_export_writer(filename_base, export_format, columns):
+    filename = '%s%s' % (filename_base, EXPORT_FORMAT_EXTENSIONS[export_format])
+
+    if export_format == EXPORT_FORMAT_TSV:
+        return filename, DelimitedExportWriter(io.open(filename, 'wb'), columns) # pylint: disable=consider-using-with
+
+    if export_format == EXPORT_FORMAT_TSV_GZIP:
+        return filename, DelimitedExportWriter(gzip.open(filename, 'wb'), columns) # pylint: disable=consider-using-with
+
+    if export_format == EXPORT_FORMAT_TSV_LZMA:
+        return filename, DelimitedExportWriter(lzma.open(filename, 'wb'), columns) # pylint: disable=consider-using-with
+
+    if export_format in (EXPORT_FORMAT_PARQUET, EXPORT_FORMAT_ARROW,):
+        return filename, ArrowExportWriter(filename, columns, export_format)
+
+    return filename, JsonLinesExportWriter(filename, columns)
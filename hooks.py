@@ -0,0 +1,76 @@
+# pylint: disable=line-too-long, global-statement
+
+import importlib
+
+from django.apps import apps
+
+HOOK_MODULE_NAMES = (
+    'dialog_api',
+    'simple_messaging_api',
+)
+
+HOOK_MODULES = None
+HOOK_REGISTRY = {}
+
+def build_hook_registry():
+    global HOOK_MODULES
+
+    hook_modules = {}
+
+    for module_name in HOOK_MODULE_NAMES:
+        hook_modules[module_name] = []
+
+        for app_config in apps.get_app_configs():
+            try:
+                hook_modules[module_name].append(importlib.import_module('%s.%s' % (app_config.name, module_name)))
+            except ImportError:
+                pass
+
+    HOOK_REGISTRY.clear()
+
+    HOOK_MODULES = hook_modules
+
+def fetch_hooks(hook_name, module_name='dialog_api'):
+    hook_key = (module_name, hook_name,)
+
+    hooks = HOOK_REGISTRY.get(hook_key, None)
+
+    if hooks is None:
+        if HOOK_MODULES is None:
+            build_hook_registry()
+
+        hooks = []
+
+        for module in HOOK_MODULES.get(module_name, []):
+            hook = getattr(module, hook_name, None)
+
+            if callable(hook):
+                hooks.append(hook)
+
+        HOOK_REGISTRY[hook_key] = hooks
+
+    return hooks
+
+def fetch_preferred_hooks(hook_names, module_name='dialog_api'):
+    hook_key = (module_name, tuple(hook_names),)
+
+    hooks = HOOK_REGISTRY.get(hook_key, None)
+
+    if hooks is None:
+        if HOOK_MODULES is None:
+            build_hook_registry()
+
+        hooks = []
+
+        for module in HOOK_MODULES.get(module_name, []):
+            for hook_name in hook_names:
+                hook = getattr(module, hook_name, None)
+
+                if callable(hook):
+                    hooks.append((hook_name, hook,))
+
+                    break
+
+        HOOK_REGISTRY[hook_key] = hooks
+
+    return hooks
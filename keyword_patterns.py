@@ -0,0 +1,99 @@
+# pylint: disable=line-too-long
+
+import re
+
+GLOBAL_FLAGS_PATTERN = re.compile(r'\(\?[aiLmsux]+\)')
+
+def keyword_pattern(keyword):
+    if keyword.match_mode == 'regex':
+        pattern = keyword.keyword
+
+        re.compile(pattern) # Raises re.error for invalid patterns
+    else:
+        pattern = re.escape(keyword.keyword)
+
+    if keyword.match_mode == 'token':
+        pattern = r'(?<!\w)(?:%s)(?!\w)' % pattern
+
+    if keyword.case_sensitive is False:
+        pattern = '(?i:%s)' % pattern
+
+    if keyword.match_mode == 'prefix':
+        return pattern
+
+    return r'[\s\S]*?(?:%s)' % pattern
+
+def combined_pattern(group_name, pattern):
+    return '(?=(?P<%s>%s))?' % (group_name, pattern)
+
+def combination_problems(pattern):
+    # Constructs that only work when the pattern is compiled on its own - inside the combined matcher, global
+    # flags are no longer at the start, group names can collide and group numbers shift.
+
+    problems = []
+
+    index = 0
+    in_class = False
+
+    while index < len(pattern):
+        char = pattern[index]
+
+        if char == '\\':
+            next_char = pattern[(index + 1):(index + 2)]
+
+            if in_class is False and next_char.isdigit() and next_char != '0':
+                problems.append('numeric backreferences')
+
+            index += 2
+        elif in_class:
+            if char == ']':
+                in_class = False
+
+            index += 1
+        elif char == '[':
+            in_class = True
+
+            index += 1
+
+            if pattern[index:(index + 1)] == '^':
+                index += 1
+
+            if pattern[index:(index + 1)] == ']': # Leading "]" is a literal
+                index += 1
+        else:
+            if pattern.startswith('(?P<', index) or pattern.startswith('(?P=', index):
+                problems.append('named groups')
+            elif pattern.startswith('(?(', index):
+                problems.append('conditional group references')
+            elif GLOBAL_FLAGS_PATTERN.match(pattern, index) is not None:
+                problems.append('global inline flags (use scoped flags like "(?i:...)" or the case sensitive option)')
+
+            index += 1
+
+    return sorted(set(problems))
+
+def combinable_keyword_pattern(keyword, group_name='k0'):
+    # Returns the keyword's pattern as it appears in the combined matcher, raising re.error if it can't be combined.
+
+    if keyword.match_mode == 'regex':
+        problems = combination_problems(keyword.keyword)
+
+        if problems:
+            raise re.error('Unsupported in launch keywords: %s' % ', '.join(problems))
+
+    pattern = combined_pattern(group_name, keyword_pattern(keyword))
+
+    re.compile(pattern)
+
+    return pattern
+
+def standalone_keyword_matcher(keyword):
+    if keyword.match_mode == 'regex':
+        flags = 0
+
+        if keyword.case_sensitive is False:
+            flags = re.IGNORECASE
+
+        return re.compile(keyword.keyword, flags).search
+
+    return re.compile(keyword_pattern(keyword)).match
@@ -0,0 +1,141 @@
+# pylint: disable=line-too-long, no-member
+
+import logging
+import re
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from django_dialog_engine.models import DialogScript
+
+from .keyword_patterns import combinable_keyword_pattern, standalone_keyword_matcher
+from .models import LaunchKeyword
+
+# Processes compare their index against this stamp, so an edit made anywhere triggers a rebuild everywhere the
+# cache is shared. The TTL bounds staleness where it isn't (such as the default per-process LocMemCache).
+
+KEYWORD_INDEX_VERSION_KEY = 'simple_messaging_dialog_support_launch_keyword_index_version'
+
+KEYWORD_INDEX_LOCK = threading.Lock()
+
+KEYWORD_INDEX = {
+    'version': None,
+    'index': None,
+    'built': None,
+}
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+class LaunchKeywordIndex(): # pylint: disable=too-few-public-methods
+    def __init__(self, keywords):
+        self.exact = {}
+        self.casefolded = {}
+        self.catch_all = []
+        self.patterns = {}
+        self.pattern_matcher = None
+        self.standalone = []
+
+        pattern_groups = []
+
+        for order, keyword in enumerate(keywords):
+            entry = (-keyword.priority, order, keyword,)
+
+            if keyword.keyword == '*':
+                self.catch_all.append(entry)
+            elif keyword.match_mode in (None, '', 'exact',):
+                if keyword.case_sensitive:
+                    self.exact.setdefault(keyword.keyword, []).append(entry)
+                else:
+                    self.casefolded.setdefault(keyword.keyword.casefold(), []).append(entry)
+            else:
+                group_name = 'k%s' % order
+
+                try:
+                    pattern_groups.append(combinable_keyword_pattern(keyword, group_name))
+
+                    self.patterns[group_name] = entry
+                except re.error:
+                    self.add_standalone(entry)
+
+        # Every combinable keyword becomes an optional lookahead anchored at the start of the message, so a
+        # single match() call reports all matching keywords via their named groups.
+
+        if pattern_groups:
+            try:
+                self.pattern_matcher = re.compile(''.join(pattern_groups))
+            except re.error:
+                logger.error('Unable to combine launch keyword patterns - matching each separately.')
+
+                for entry in self.patterns.values():
+                    self.add_standalone(entry)
+
+                self.patterns = {}
+
+        self.catch_all = [entry[2] for entry in sorted(self.catch_all, key=lambda entry: entry[:2])]
+
+    def add_standalone(self, entry):
+        keyword = entry[2]
+
+        try:
+            self.standalone.append((standalone_keyword_matcher(keyword), entry,))
+        except re.error:
+            logger.error('Skipping launch keyword %s with invalid pattern: %s', keyword.pk, keyword.keyword)
+
+    def candidates(self, message):
+        entries = self.exact.get(message, []) + self.casefolded.get(message.casefold(), [])
+
+        if self.pattern_matcher is not None:
+            match = self.pattern_matcher.match(message)
+
+            for group_name, value in match.groupdict().items():
+                if value is not None:
+                    entries.append(self.patterns[group_name])
+
+        for matcher, entry in self.standalone:
+            if matcher(message) is not None:
+                entries.append(entry)
+
+        return [entry[2] for entry in sorted(entries, key=lambda entry: entry[:2])]
+
+def keyword_index_version():
+    version = cache.get(KEYWORD_INDEX_VERSION_KEY)
+
+    if version is None:
+        cache.add(KEYWORD_INDEX_VERSION_KEY, uuid.uuid4().hex, None)
+
+        version = cache.get(KEYWORD_INDEX_VERSION_KEY)
+
+    return version
+
+def keyword_index_ttl():
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_KEYWORD_INDEX_TTL', 60)
+
+def fetch_keyword_index():
+    version = keyword_index_version()
+
+    now = time.monotonic()
+
+    with KEYWORD_INDEX_LOCK:
+        if KEYWORD_INDEX['index'] is None or KEYWORD_INDEX['version'] != version or (now - KEYWORD_INDEX['built']) >= keyword_index_ttl():
+            keywords = LaunchKeyword.objects.all().select_related('dialog_script').order_by('-priority', 'pk')
+
+            KEYWORD_INDEX['index'] = LaunchKeywordIndex(list(keywords))
+            KEYWORD_INDEX['version'] = version
+            KEYWORD_INDEX['built'] = now
+
+        return KEYWORD_INDEX['index']
+
+@receiver(post_save, sender=LaunchKeyword)
+@receiver(post_delete, sender=LaunchKeyword)
+@receiver(post_save, sender=DialogScript)
+@receiver(post_delete, sender=DialogScript)
+def invalidate_keyword_index(sender, **kwargs): # pylint: disable=unused-argument
+    cache.set(KEYWORD_INDEX_VERSION_KEY, uuid.uuid4().hex, None)
+
+    with KEYWORD_INDEX_LOCK:
+        KEYWORD_INDEX['index'] = None
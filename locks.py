@@ -0,0 +1,194 @@
+# pylint: disable=line-too-long
+
+import errno
+import os
+import tempfile
+import threading
+import time
+import weakref
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import OperationalError, connections
+from django.template.defaultfilters import slugify
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows
+    fcntl = None
+
+LOCK_BACKEND_POSTGRES = 'postgres'
+LOCK_BACKEND_FCNTL = 'fcntl'
+LOCK_BACKEND_PROCESS = 'process'
+
+class LockTimeoutError(Exception):
+    pass
+
+def lock_backend():
+    default_backend = LOCK_BACKEND_FCNTL
+
+    if fcntl is None:
+        default_backend = LOCK_BACKEND_PROCESS
+
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_LOCK_BACKEND', default_backend)
+
+def lock_namespace():
+    return slugify(settings.ALLOWED_HOSTS[0])
+
+@contextmanager
+def postgres_lock(lock_name, timeout=None):
+    from django_pglocks import advisory_lock as pg_advisory_lock # pylint: disable=import-outside-toplevel
+
+    using = getattr(settings, 'SIMPLE_MESSAGING_DIALOG_LOCK_DATABASE', 'default')
+
+    lock_id = '%s_%s' % (lock_namespace(), lock_name)
+
+    if timeout is None:
+        with pg_advisory_lock(lock_id, using=using):
+            yield lock_id
+
+        return
+
+    acquired = False
+
+    # Inside a transaction the timeout is scoped to it - a timeout aborts the transaction, so nothing can be
+    # reset until the caller rolls back, and the rollback restores the previous setting anyway.
+
+    in_atomic = connections[using].in_atomic_block
+
+    with connections[using].cursor() as cursor:
+        if in_atomic:
+            cursor.execute('SET LOCAL lock_timeout = %s', ['%dms' % int(timeout * 1000)])
+        else:
+            cursor.execute('SET lock_timeout = %s', ['%dms' % int(timeout * 1000)])
+
+    try:
+        with pg_advisory_lock(lock_id, using=using):
+            acquired = True
+
+            with connections[using].cursor() as cursor:
+                cursor.execute('RESET lock_timeout')
+
+            yield lock_id
+    except OperationalError:
+        if acquired:
+            raise
+
+        if in_atomic is False:
+            with connections[using].cursor() as cursor:
+                cursor.execute('RESET lock_timeout')
+
+        raise LockTimeoutError('Timeout reached acquiring lock for %s (%f seconds)' % (lock_name, timeout)) # pylint: disable=raise-missing-from
+
+def open_lock_file(file_path, lock_name, timeout=None):
+    deadline = None
+
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+
+    while True:
+        lock_file = open(file_path, 'ab') # pylint: disable=consider-using-with
+
+        try:
+            while True:
+                try:
+                    if deadline is None:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                    else:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+                    break
+                except (IOError, OSError) as error:
+                    if deadline is None or error.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+
+                    if time.monotonic() > deadline:
+                        raise LockTimeoutError('Timeout reached acquiring lock for %s (%f seconds)' % (lock_name, timeout)) # pylint: disable=raise-missing-from
+
+                    time.sleep(0.05)
+
+            # The previous holder may have removed the file after we opened it - only a lock on the file
+            # currently at file_path counts.
+
+            try:
+                if os.stat(file_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    return lock_file
+            except FileNotFoundError:
+                pass
+        except:
+            lock_file.close()
+
+            raise
+
+        lock_file.close()
+
+@contextmanager
+def fcntl_lock(lock_name, timeout=None):
+    tmp_dir = tempfile.gettempdir()
+
+    if hasattr(settings, 'QUICKSILVER_LOCK_DIR'):
+        tmp_dir = settings.QUICKSILVER_LOCK_DIR
+
+    file_path = '%s/%s_%s.lock' % (tmp_dir, lock_namespace(), lock_name)
+
+    lock_file = open_lock_file(file_path, lock_name, timeout=timeout)
+
+    try:
+        yield file_path
+    finally:
+        # Removed while still held, so waiters that opened the old file retry against a new one. A file left
+        # behind by a crash is harmless - the kernel drops the lock when the descriptor closes.
+
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+        lock_file.close()
+
+PROCESS_LOCKS = weakref.WeakValueDictionary()
+PROCESS_LOCKS_GUARD = threading.Lock()
+
+@contextmanager
+def process_lock(lock_name, timeout=None):
+    with PROCESS_LOCKS_GUARD:
+        lock = PROCESS_LOCKS.get(lock_name, None)
+
+        if lock is None:
+            lock = threading.Lock()
+
+            PROCESS_LOCKS[lock_name] = lock
+
+    if timeout is None:
+        acquired = lock.acquire()
+    else:
+        acquired = lock.acquire(True, timeout)
+
+    if acquired is False:
+        raise LockTimeoutError('Timeout reached acquiring lock for %s (%f seconds)' % (lock_name, timeout))
+
+    try:
+        yield lock_name
+    finally:
+        lock.release()
+
+LOCK_BACKENDS = {
+    LOCK_BACKEND_POSTGRES: postgres_lock,
+    LOCK_BACKEND_FCNTL: fcntl_lock,
+    LOCK_BACKEND_PROCESS: process_lock,
+}
+
+@contextmanager
+def advisory_lock(lock_name, timeout=None):
+    backend = lock_backend()
+
+    lock_function = LOCK_BACKENDS.get(backend, None)
+
+    if lock_function is None:
+        raise ValueError('Unknown SIMPLE_MESSAGING_DIALOG_LOCK_BACKEND: %s' % backend)
+
+    with lock_function(lock_name, timeout=timeout) as lock_handle:
+        yield lock_handle
@@ -1,70 +1,136 @@
 # pylint: disable=no-member, line-too-long
 
-import importlib
 import logging
+import threading
 import traceback
 
-from django.conf import settings
+from concurrent.futures import ThreadPoolExecutor
+
 from django.core.management import call_command
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.db.models.functions import Mod
+from django.utils import timezone
 
 from quicksilver.decorators import handle_lock, handle_schedule, add_qs_arguments, handle_logging
 
+from ...decrypt_cache import decrypt_cache_stats
+from ...hooks import fetch_hooks
 from ...models import DialogSession
 
+def parse_shard(shard):
+    try:
+        shard_index, shard_count = [int(part) for part in shard.split('/')]
+    except ValueError:
+        raise CommandError('--shard must look like N/M (for example 1/4): %s' % shard) # pylint: disable=raise-missing-from
+
+    if shard_count < 1 or shard_index < 1 or shard_index > shard_count:
+        raise CommandError('--shard N/M requires 1 <= N <= M: %s' % shard)
+
+    return shard_index, shard_count
+
+def nudge_session(session):
+    do_nudge = True
+
+    session_variables = session.fetch_latest_variables()
+
+    for allow_session_nudge in fetch_hooks('allow_session_nudge'):
+        if do_nudge:
+            do_nudge = allow_session_nudge(session)
+
+    launch_keyword = session_variables.get('simple_messaging_launch_keyword', None)
+    launch_keyword_consumed = session_variables.get('simple_messaging_launch_keyword_consumed', False)
+
+    if launch_keyword is not None and launch_keyword_consumed is False:
+        do_nudge = True
+
+        session.add_variable('simple_messaging_launch_keyword_consumed', True)
+    else:
+        launch_keyword = None
+
+    if do_nudge:
+        logging.info('Nudging session: %s', session)
+
+        try:
+            session.process_response(launch_keyword, None, send_messages=False, logger=logging.getLogger())
+        except Exception as exc: # pylint: disable=bare-except, broad-exception-caught
+            logging.error('Error encountered with session %s:', session.pk)
+            logging.error(traceback.format_exc())
+
+            return exc
+    else:
+        logging.info('Skipping nudge for session: %s.', session.pk)
+
+    return None
+
+def nudge_session_worker(session):
+    try:
+        return nudge_session(session)
+    except Exception as exc: # pylint: disable=broad-exception-caught
+        logging.error('Error encountered with session %s:', session.pk)
+        logging.error(traceback.format_exc())
+
+        return exc
+    finally:
+        connection.close() # Worker threads hold their own connections
+
 class Command(BaseCommand):
     help = 'Nudges ongoing dialog session to continue processing as needed'
 
     @add_qs_arguments
     def add_arguments(self, parser):
-        pass
+        parser.add_argument('--workers', type=int, default=1, help='Sessions nudged in parallel (each in its own thread and database connection)')
+        parser.add_argument('--shard', type=str, default=None, help='Only nudge shard N of M (N/M), partitioning open sessions by ID so several nodes can split the work')
 
     @handle_logging
     @handle_schedule
     @handle_lock
-    def handle(self, *args, **options):
+    def handle(self, *args, **options): # pylint: disable=too-many-locals
         exception = None
 
-        for session in DialogSession.objects.filter(finished=None).order_by('-pk'):
-            do_nudge = True
+        now = timezone.now()
+
+        sessions = DialogSession.objects.filter(finished=None).filter(Q(next_wakeup_at=None) | Q(next_wakeup_at__lte=now))
+
+        if options.get('shard', None) is not None:
+            shard_index, shard_count = parse_shard(options['shard'])
+
+            sessions = sessions.annotate(nudge_shard=Mod('pk', shard_count)).filter(nudge_shard=(shard_index - 1))
+
+        sessions = sessions.order_by('-pk').iterator(chunk_size=500)
+
+        workers = max(1, options.get('workers', 1))
 
-            session_variables = session.fetch_latest_variables()
+        if workers == 1:
+            for session in sessions:
+                session_exception = nudge_session(session)
 
-            for app in settings.INSTALLED_APPS:
-                if do_nudge:
-                    try:
-                        dialog_module = importlib.import_module('.dialog_api', package=app)
+                if session_exception is not None:
+                    exception = session_exception
+        else:
+            # Bound the sessions in flight so the queryset keeps streaming instead of queueing every session.
 
-                        do_nudge = dialog_module.allow_session_nudge(session)
-                    except ImportError:
-                        pass # traceback.print_exc()
-                    except AttributeError:
-                        pass # traceback.print_exc()
+            in_flight = threading.BoundedSemaphore(workers * 2)
 
-            launch_keyword = session_variables.get('simple_messaging_launch_keyword', None)
-            launch_keyword_consumed = session_variables.get('simple_messaging_launch_keyword_consumed', False)
+            session_exceptions = []
 
-            if launch_keyword is not None and launch_keyword_consumed is False:
-                do_nudge = True
+            def finish_session(future):
+                if future.result() is not None:
+                    session_exceptions.append(future.result())
 
-                session.add_variable('simple_messaging_launch_keyword_consumed', True)
-            else:
-                launch_keyword = None
+                in_flight.release()
 
-            if do_nudge:
-                logging.info('Nudging session: %s', session)
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='nudge_active_sessions') as executor:
+                for session in sessions:
+                    in_flight.acquire() # pylint: disable=consider-using-with
 
-                try:
-                    session.process_response(launch_keyword, None, send_messages=False, logger=logging.getLogger())
-                except Exception as exc: # pylint: disable=bare-except, broad-exception-caught
-                    logging.error('Error encountered with session %s:', session.pk)
-                    logging.error(traceback.format_exc())
+                    executor.submit(nudge_session_worker, session).add_done_callback(finish_session)
 
-                    exception = exc
-            else:
-                logging.info('Skipping nudge for session: %s.', session.pk)
+            if session_exceptions:
+                exception = session_exceptions[-1]
 
-        logging.info('Open sessions nudged.')
+        logging.info('Open sessions nudged. Decryption cache: %s', decrypt_cache_stats())
 
         try:
             call_command('simple_messaging_send_pending_messages', '-v', '%s' % options.get('verbosity', -1))
@@ -0,0 +1,29 @@
+# pylint: disable=no-member, line-too-long
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from quicksilver.decorators import handle_lock, handle_schedule, add_qs_arguments, handle_logging
+
+from ...media_queue import process_pending_media
+from ...models import PendingMessageMedia
+
+class Command(BaseCommand):
+    help = 'Attaches media to outgoing dialog messages still waiting on it and releases them for sending.'
+
+    @add_qs_arguments
+    def add_arguments(self, parser):
+        pass
+
+    @handle_logging
+    @handle_schedule
+    @handle_lock
+    def handle(self, *args, **options):
+        released = 0
+
+        for pending_pk in PendingMessageMedia.objects.order_by('added').values_list('pk', flat=True):
+            if process_pending_media(pending_pk):
+                released += 1
+
+        logging.info('Released %s message(s) waiting on media.', released)
@@ -0,0 +1,22 @@
+# pylint: disable=no-member, line-too-long
+
+from django.core.management.base import BaseCommand
+
+from quicksilver.decorators import handle_lock
+
+from ...models import DialogSession, generate_lookup_hash
+
+class Command(BaseCommand):
+    help = 'Populates missing destination lookup hashes on dialog sessions.'
+
+    @handle_lock
+    def handle(self, *args, **options):
+        updated = 0
+
+        for session in DialogSession.objects.filter(lookup_hash=None).iterator():
+            session.lookup_hash = generate_lookup_hash(session.current_destination())
+            session.save(update_fields=['lookup_hash'])
+
+            updated += 1
+
+        self.stdout.write('Updated %s dialog session(s).' % updated)
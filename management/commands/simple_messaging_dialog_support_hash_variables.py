@@ -0,0 +1,176 @@
+# pylint: disable=no-member, line-too-long
+
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+
+from queue import Empty
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Max, Min
+
+from quicksilver.decorators import handle_lock
+
+from ...models import DialogVariable, generate_lookup_hash
+
+def hash_variable_range(range_index, last_pk, end_pk, batch_size, progress_queue=None):
+    hashed = 0
+
+    while True:
+        batch = list(DialogVariable.objects.filter(lookup_hash=None, pk__gt=last_pk, pk__lte=end_pk).order_by('pk').only('pk', 'sender')[:batch_size])
+
+        if len(batch) == 0: # pylint: disable=len-as-condition
+            break
+
+        for variable in batch:
+            variable.lookup_hash = generate_lookup_hash(variable.current_sender())
+
+        DialogVariable.objects.bulk_update(batch, ['lookup_hash'])
+
+        last_pk = batch[-1].pk
+        hashed += len(batch)
+
+        if progress_queue is not None:
+            progress_queue.put((range_index, last_pk, len(batch),))
+
+    if progress_queue is not None:
+        progress_queue.put((range_index, None, 0,))
+
+    return hashed
+
+def hash_variable_range_worker(range_index, last_pk, end_pk, batch_size, progress_queue):
+    connections.close_all() # Never share the parent's connection across processes
+
+    try:
+        hash_variable_range(range_index, last_pk, end_pk, batch_size, progress_queue)
+    finally:
+        connections.close_all()
+
+class Command(BaseCommand):
+    help = 'Backfills missing lookup hashes on dialog variables in resumable, keyset-paginated batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Variables hashed per bulk update')
+        parser.add_argument('--workers', type=int, default=1, help='Parallel worker processes')
+        parser.add_argument('--checkpoint', type=str, default=os.path.join(tempfile.gettempdir(), 'simple_messaging_dialog_support_hash_variables.json'), help='Checkpoint file used to resume an interrupted backfill')
+        parser.add_argument('--restart', action='store_true', default=False, help='Ignore any existing checkpoint')
+
+    def load_checkpoint(self, options):
+        if options['restart'] is False and os.path.exists(options['checkpoint']):
+            with io.open(options['checkpoint'], 'r', encoding='utf-8') as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+
+            self.stdout.write('Resuming from checkpoint %s.' % options['checkpoint'])
+
+            return checkpoint
+
+        bounds = DialogVariable.objects.filter(lookup_hash=None).aggregate(first_pk=Min('pk'), last_pk=Max('pk'))
+
+        if bounds['first_pk'] is None:
+            return None
+
+        workers = max(1, options['workers'])
+
+        span = ((bounds['last_pk'] - bounds['first_pk']) // workers) + 1
+
+        ranges = []
+
+        for worker_index in range(0, workers):
+            range_start = bounds['first_pk'] - 1 + (worker_index * span)
+            range_end = min(range_start + span, bounds['last_pk'])
+
+            if range_start < range_end:
+                ranges.append({
+                    'last_pk': range_start,
+                    'end_pk': range_end,
+                    'complete': False,
+                })
+
+        return {
+            'ranges': ranges,
+        }
+
+    def save_checkpoint(self, options, checkpoint):
+        temp_path = '%s.tmp' % options['checkpoint']
+
+        with io.open(temp_path, 'w', encoding='utf-8') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file, indent=2)
+
+        os.replace(temp_path, options['checkpoint'])
+
+    @handle_lock
+    def handle(self, *args, **options): # pylint: disable=too-many-locals
+        checkpoint = self.load_checkpoint(options)
+
+        if checkpoint is None:
+            self.stdout.write('All dialog variables already have lookup hashes.')
+
+            return
+
+        remaining = DialogVariable.objects.filter(lookup_hash=None).count()
+
+        self.stdout.write('%s variable(s) to hash across %s range(s).' % (remaining, len(checkpoint['ranges'])))
+
+        self.save_checkpoint(options, checkpoint)
+
+        context = multiprocessing.get_context('fork')
+
+        progress_queue = context.Queue()
+
+        workers = []
+
+        connections.close_all()
+
+        for range_index, hash_range in enumerate(checkpoint['ranges']):
+            if hash_range['complete'] is False:
+                worker = context.Process(target=hash_variable_range_worker, args=(range_index, hash_range['last_pk'], hash_range['end_pk'], options['batch_size'], progress_queue,))
+                worker.start()
+
+                workers.append(worker)
+
+        active = len(workers)
+        hashed = 0
+
+        while active > 0:
+            try:
+                range_index, last_pk, count = progress_queue.get(timeout=5)
+            except Empty:
+                if any(worker.is_alive() for worker in workers):
+                    continue
+
+                break # Workers exited without reporting completion
+
+            if last_pk is None:
+                checkpoint['ranges'][range_index]['complete'] = True
+
+                active -= 1
+            else:
+                checkpoint['ranges'][range_index]['last_pk'] = last_pk
+
+                hashed += count
+
+                self.stdout.write('Hashed %s / %s variables...' % (hashed, remaining))
+
+            self.save_checkpoint(options, checkpoint)
+
+        for worker in workers:
+            worker.join()
+
+        failed = [worker for worker in workers if worker.exitcode != 0]
+
+        if failed:
+            self.stderr.write('%s worker(s) failed - rerun to resume from %s.' % (len(failed), options['checkpoint']))
+
+            return
+
+        if DialogVariable.objects.filter(lookup_hash=None).exists():
+            self.stdout.write('Hashed %s variable(s). Unhashed variables remain (added during the run?) - rerun with --restart.' % hashed)
+
+            return
+
+        os.remove(options['checkpoint'])
+
+        self.stdout.write('Hashed %s variable(s). Backfill complete - set SIMPLE_MESSAGING_DIALOG_VARIABLE_HASHES_COMPLETE = True to skip unhashed rows on reads.' % hashed)
@@ -0,0 +1,33 @@
+# pylint: disable=no-member, line-too-long
+
+from django.core.management.base import BaseCommand
+
+from quicksilver.decorators import handle_lock
+
+from ...models import DialogSession
+
+class Command(BaseCommand):
+    help = 'Rebuilds the latest-variable snapshots of dialog sessions from the variable history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--include-finished', action='store_true', default=False, help='Also rebuild snapshots of finished sessions')
+        parser.add_argument('--session', type=int, action='append', default=[], help='Only rebuild the given session ID (may be repeated)')
+
+    @handle_lock
+    def handle(self, *args, **options):
+        sessions = DialogSession.objects.all()
+
+        if options['include_finished'] is False:
+            sessions = sessions.filter(finished=None)
+
+        if options['session']:
+            sessions = sessions.filter(pk__in=options['session'])
+
+        rebuilt = 0
+
+        for session in sessions.order_by('pk').iterator():
+            session.rebuild_variable_snapshot()
+
+            rebuilt += 1
+
+        self.stdout.write('Rebuilt %s variable snapshot(s).' % rebuilt)
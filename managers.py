@@ -0,0 +1,126 @@
+# pylint: disable=line-too-long, no-member
+
+import hashlib
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from django_dialog_engine.models import Dialog
+
+from simple_messaging.models import encrypt_value
+
+from .decrypt_cache import cached_decrypt_value, prime_decrypt_cache
+
+def generate_lookup_hash(value):
+    hash_obj = hashlib.sha256()
+    hash_obj.update(value.encode('utf-8'))
+
+    return hash_obj.hexdigest()
+
+def variable_hashes_complete():
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_VARIABLE_HASHES_COMPLETE', False)
+
+def variable_sender_query(*senders):
+    query = Q(lookup_hash__in=[generate_lookup_hash(sender) for sender in senders])
+
+    if variable_hashes_complete() is False:
+        query = query | Q(lookup_hash=None) # Legacy rows not yet backfilled - see simple_messaging_dialog_support_hash_variables
+
+    return query
+
+def encrypt_address(address):
+    if address is None:
+        return None, None
+
+    plaintext = address
+
+    if address.startswith('secret:'):
+        plaintext = cached_decrypt_value(address)
+    elif hasattr(settings, 'SIMPLE_MESSAGING_SECRET_KEY'):
+        address = encrypt_value(plaintext)
+
+        prime_decrypt_cache(address, plaintext)
+
+    return address, generate_lookup_hash(plaintext)
+
+class DialogSessionManager(models.Manager):
+    def create_encrypted(self, destination, **kwargs):
+        encrypted_destination, lookup_hash = encrypt_address(destination)
+
+        return self.create(destination=encrypted_destination, lookup_hash=lookup_hash, **kwargs)
+
+    def for_destination(self, destination):
+        # Sessions created before lookup hashes were introduced are included until backfilled.
+        # Callers must still confirm matches with current_destination().
+
+        query = Q(lookup_hash=generate_lookup_hash(destination)) | Q(lookup_hash=None)
+
+        return self.filter(query)
+
+    def cancel_for_destination(self, destination, finish_reason):
+        open_sessions = self.filter(finished=None)
+
+        with transaction.atomic():
+            matches = list(open_sessions.filter(lookup_hash=generate_lookup_hash(destination)).values_list('pk', 'dialog_id'))
+
+            # Only sessions without lookup hashes still need their destinations decrypted to confirm a match.
+
+            for session in open_sessions.filter(lookup_hash=None).only('pk', 'destination', 'dialog_id'):
+                if session.current_destination() == destination:
+                    matches.append((session.pk, session.dialog_id,))
+
+            if len(matches) == 0: # pylint: disable=len-as-condition
+                return 0
+
+            now = timezone.now()
+
+            self.filter(pk__in=[session_pk for session_pk, dialog_pk in matches]).update(finished=now)
+
+            # Dialogs that already finished (such as timed out ones) keep their original finish reason.
+
+            Dialog.objects.filter(pk__in=[dialog_pk for session_pk, dialog_pk in matches if dialog_pk is not None], finished=None).update(finished=now, finish_reason=finish_reason)
+
+        return len(matches)
+
+class DialogVariableManager(models.Manager):
+    def create_encrypted(self, sender, **kwargs):
+        encrypted_sender, lookup_hash = encrypt_address(sender)
+
+        return self.create(sender=encrypted_sender, lookup_hash=lookup_hash, **kwargs)
+
+    def bulk_create_encrypted(self, variables):
+        to_create = []
+
+        for variable in variables:
+            fields = dict(variable)
+
+            fields['sender'], fields['lookup_hash'] = encrypt_address(fields['sender'])
+
+            to_create.append(self.model(**fields))
+
+        return self.bulk_create(to_create)
+
+    def latest_for_sender(self, sender, dialog_key, key):
+        # Served by the (lookup_hash, dialog_key, key, date_set) index - a single row regardless of key popularity.
+
+        latest = self.filter(lookup_hash=generate_lookup_hash(sender), dialog_key=dialog_key, key=key).order_by('-date_set').first()
+
+        if variable_hashes_complete() is False:
+            legacy_variables = self.filter(lookup_hash=None, dialog_key=dialog_key, key=key)
+
+            if latest is not None:
+                legacy_variables = legacy_variables.filter(date_set__gt=latest.date_set)
+
+            for variable in legacy_variables.order_by('-date_set'):
+                if variable.current_sender() == sender:
+                    return variable
+
+        return latest
+
+class DialogAlertManager(models.Manager): # pylint: disable=too-few-public-methods
+    def create_encrypted(self, sender, **kwargs):
+        encrypted_sender = encrypt_address(sender)[0]
+
+        return self.create(sender=encrypted_sender, **kwargs)
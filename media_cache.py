@@ -0,0 +1,174 @@
+# pylint: disable=line-too-long, no-member
+
+import datetime
+import hashlib
+import logging
+import mimetypes
+import urllib.parse
+
+import requests
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import Sum
+from django.utils import timezone
+
+from simple_messaging.models import OutgoingMessageMedia
+
+from .models import MediaCacheEntry, generate_lookup_hash
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+def media_cache_max_bytes():
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_MEDIA_CACHE_MAX_BYTES', 1024 * 1024 * 1024)
+
+def media_cache_max_age():
+    return datetime.timedelta(seconds=getattr(settings, 'SIMPLE_MESSAGING_DIALOG_MEDIA_CACHE_MAX_AGE', 300))
+
+def media_fetch_timeout():
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_MEDIA_TIMEOUT', 300)
+
+def file_in_use(content_file_name):
+    if MediaCacheEntry.objects.filter(content_file=content_file_name).exists():
+        return True
+
+    return OutgoingMessageMedia.objects.filter(content_file=content_file_name).exists()
+
+def evict_media(max_bytes=None, keep=None):
+    if max_bytes is None:
+        max_bytes = media_cache_max_bytes()
+
+    total_size = MediaCacheEntry.objects.aggregate(total=Sum('size'))['total']
+
+    if total_size is None or total_size <= max_bytes:
+        return
+
+    entries = MediaCacheEntry.objects.order_by('last_used')
+
+    if keep is not None:
+        entries = entries.exclude(pk=keep.pk)
+
+    for entry in entries:
+        if total_size <= max_bytes:
+            break
+
+        content_file_name = entry.content_file.name
+
+        storage = entry.content_file.storage
+
+        total_size -= entry.size
+
+        entry.delete()
+
+        # Files already attached to outgoing messages stay in place - only the cache's claim is dropped.
+
+        if content_file_name and file_in_use(content_file_name) is False:
+            storage.delete(content_file_name)
+
+def media_filename(media_url, content_type, content_hash):
+    # Files are shared by content, so they live under the content hash but keep the name from the URL.
+
+    filename = urllib.parse.urlparse(media_url).path.split('/')[-1]
+
+    if filename == '':
+        filename = content_hash
+
+    file_extension = mimetypes.guess_extension(content_type.split(';')[0].strip())
+
+    if file_extension is not None and '.' not in filename:
+        filename = '%s%s' % (filename, file_extension)
+
+    return '%s/%s' % (content_hash, filename)
+
+def store_media(media_url, response, entry=None):
+    now = timezone.now()
+
+    content_type = response.headers.get('content-type', 'application/octet-stream')
+
+    hash_obj = hashlib.sha256()
+    hash_obj.update(response.content)
+
+    content_hash = hash_obj.hexdigest()
+
+    previous_file_name = None
+
+    if entry is None:
+        entry = MediaCacheEntry(url=media_url, fetched=now)
+    else:
+        previous_file_name = entry.content_file.name
+
+    existing = MediaCacheEntry.objects.filter(content_hash=content_hash).exclude(content_file='').first()
+
+    if existing is not None and existing.content_file.storage.exists(existing.content_file.name):
+        entry.content_file.name = existing.content_file.name # Identical content - share the stored file
+    else:
+        entry.content_file.save(media_filename(media_url, content_type, content_hash), ContentFile(response.content), save=False)
+
+    entry.content_hash = content_hash
+    entry.content_type = content_type
+    entry.size = len(response.content)
+    entry.etag = response.headers.get('etag', None)
+    entry.last_modified = response.headers.get('last-modified', None)
+    entry.fetched = now
+    entry.last_validated = now
+    entry.last_used = now
+    entry.save()
+
+    if previous_file_name and previous_file_name != entry.content_file.name and file_in_use(previous_file_name) is False:
+        entry.content_file.storage.delete(previous_file_name)
+
+    evict_media(keep=entry)
+
+    return entry
+
+def fetch_media(media_url):
+    now = timezone.now()
+
+    entry = MediaCacheEntry.objects.filter(url_hash=generate_lookup_hash(media_url)).filter(url=media_url).order_by('-last_validated').first()
+
+    if entry is not None and entry.content_file.storage.exists(entry.content_file.name) is False:
+        entry.delete()
+
+        entry = None
+
+    if entry is not None and (now - entry.last_validated) < media_cache_max_age():
+        MediaCacheEntry.objects.filter(pk=entry.pk).update(last_used=now)
+
+        return entry
+
+    headers = {}
+
+    if entry is not None:
+        if entry.etag is not None:
+            headers['If-None-Match'] = entry.etag
+
+        if entry.last_modified is not None:
+            headers['If-Modified-Since'] = entry.last_modified
+
+    response = requests.get(media_url, headers=headers, timeout=media_fetch_timeout())
+
+    if entry is not None and response.status_code == 304:
+        entry.last_validated = now
+        entry.last_used = now
+        entry.save(update_fields=['last_validated', 'last_used'])
+
+        return entry
+
+    if response.status_code != 200:
+        logger.error('Unable to fetch media %s: HTTP %s', media_url, response.status_code)
+
+        return None
+
+    return store_media(media_url, response, entry=entry)
+
+def attach_media(message, media_url):
+    entry = fetch_media(media_url)
+
+    if entry is None:
+        return None
+
+    media_obj = OutgoingMessageMedia(message=message, content_type=entry.content_type)
+    media_obj.content_file.name = entry.content_file.name
+    media_obj.save()
+
+    return media_obj
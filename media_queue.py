@@ -0,0 +1,148 @@
+# pylint: disable=line-too-long, no-member
+
+import datetime
+import logging
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from simple_messaging.models import OutgoingMessage
+
+from .dispatch import request_send_flush
+from .media_cache import attach_media, media_fetch_timeout
+from .models import PendingMessageMedia
+
+# Messages waiting on media are parked this far in the future so senders skip them.
+
+MEDIA_HOLD = datetime.timedelta(days=3650)
+
+MEDIA_POOL_LOCK = threading.Lock()
+
+MEDIA_POOL = {
+    'executor': None,
+}
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+def media_workers():
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_MEDIA_WORKERS', 4)
+
+def media_max_attempts():
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_MEDIA_MAX_ATTEMPTS', 3)
+
+def held_send_date(send_date):
+    return send_date + MEDIA_HOLD
+
+def media_executor():
+    with MEDIA_POOL_LOCK:
+        if MEDIA_POOL['executor'] is None:
+            MEDIA_POOL['executor'] = ThreadPoolExecutor(max_workers=media_workers(), thread_name_prefix='simple_messaging_dialog_support_media')
+
+        return MEDIA_POOL['executor']
+
+def destination_has_pending_media(lookup_hash):
+    if lookup_hash is None:
+        return False
+
+    return PendingMessageMedia.objects.filter(lookup_hash=lookup_hash).exists()
+
+def hold_message(message, send_date, lookup_hash):
+    return PendingMessageMedia.objects.create(message=message, media_url='', send_date=send_date, added=timezone.now(), lookup_hash=lookup_hash, ready=True)
+
+def queue_media(message, media_url, send_date, lookup_hash=None):
+    pending = PendingMessageMedia.objects.create(message=message, media_url=media_url, send_date=send_date, added=timezone.now(), lookup_hash=lookup_hash)
+
+    if media_workers() > 0:
+        pending_pk = pending.pk
+
+        transaction.on_commit(lambda: media_executor().submit(run_pending_media, pending_pk))
+
+    # Otherwise left to the simple_messaging_dialog_support_fetch_pending_media task.
+
+    return pending
+
+def run_pending_media(pending_pk):
+    try:
+        process_pending_media(pending_pk)
+    except: # pylint: disable=bare-except
+        logger.error(traceback.format_exc())
+    finally:
+        connection.close()
+
+def claim_pending_media(pending_pk):
+    now = timezone.now()
+
+    stale = now - datetime.timedelta(seconds=(media_fetch_timeout() * 2))
+
+    claimed = PendingMessageMedia.objects.filter(pk=pending_pk).filter(Q(claimed=None) | Q(claimed__lt=stale)).update(claimed=now)
+
+    return claimed == 1
+
+def release_message(pending):
+    OutgoingMessage.objects.filter(pk=pending.message_id).update(send_date=pending.send_date)
+
+    PendingMessageMedia.objects.filter(pk=pending.pk).delete()
+
+def release_ready_messages(lookup_hash):
+    # Releases in creation order, stopping at the first message still waiting on its media.
+
+    released = 0
+
+    for pending in PendingMessageMedia.objects.filter(lookup_hash=lookup_hash).order_by('pk'):
+        if pending.ready is False:
+            break
+
+        release_message(pending)
+
+        released += 1
+
+    return released
+
+def finish_pending_media(pending):
+    if pending.lookup_hash is None:
+        release_message(pending)
+    else:
+        PendingMessageMedia.objects.filter(pk=pending.pk).update(ready=True, claimed=None)
+
+        release_ready_messages(pending.lookup_hash)
+
+    request_send_flush()
+
+def process_pending_media(pending_pk):
+    if claim_pending_media(pending_pk) is False:
+        return False # Another worker has it
+
+    pending = PendingMessageMedia.objects.filter(pk=pending_pk).select_related('message').first()
+
+    if pending is None:
+        return False
+
+    if pending.ready:
+        finish_pending_media(pending) # Waiting on earlier media - see if it can go now
+
+        return True
+
+    try:
+        attach_media(pending.message, pending.media_url)
+    except Exception: # pylint: disable=broad-exception-caught
+        pending.attempts += 1
+        pending.last_error = traceback.format_exc()
+        pending.claimed = None
+
+        if pending.attempts < media_max_attempts():
+            pending.save()
+
+            return False
+
+        logger.error('Giving up on media %s for message %s after %s attempts - sending without media.', pending.media_url, pending.message_id, pending.attempts)
+        logger.error(pending.last_error)
+
+    finish_pending_media(pending)
+
+    return True
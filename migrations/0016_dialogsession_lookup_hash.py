@@ -0,0 +1,19 @@
+# pylint: skip-file
+# Generated by Django 3.2.25 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_messaging_dialog_support', '0015_auto_20260819_0939'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dialogsession',
+            name='lookup_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=1024, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# pylint: skip-file
+# Generated by Django 3.2.25 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_messaging_dialog_support', '0016_dialogsession_lookup_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaCacheEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(db_index=True, max_length=1024)),
+                ('content_hash', models.CharField(db_index=True, max_length=64)),
+                ('content_type', models.CharField(max_length=256)),
+                ('content_file', models.FileField(max_length=1024, upload_to='simple_messaging_dialog_support_media_cache')),
+                ('size', models.BigIntegerField(default=0)),
+                ('etag', models.CharField(blank=True, max_length=1024, null=True)),
+                ('last_modified', models.CharField(blank=True, max_length=256, null=True)),
+                ('fetched', models.DateTimeField()),
+                ('last_validated', models.DateTimeField()),
+                ('last_used', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
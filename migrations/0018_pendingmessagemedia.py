@@ -0,0 +1,29 @@
+# pylint: skip-file
+# Generated by Django 3.2.25 on 2026-10-18 11:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_messaging', '__first__'),
+        ('simple_messaging_dialog_support', '0017_mediacacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingMessageMedia',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('media_url', models.CharField(max_length=4096)),
+                ('send_date', models.DateTimeField(help_text='Send date to restore once media is attached.')),
+                ('added', models.DateTimeField()),
+                ('claimed', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_dialog_media', to='simple_messaging.outgoingmessage')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# pylint: skip-file
+# Generated by Django 3.2.25 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_messaging_dialog_support', '0018_pendingmessagemedia'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dialogvariable',
+            index=models.Index(fields=['lookup_hash', 'dialog_key', 'key', 'date_set'], name='smds_variable_latest_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# pylint: skip-file
+# Generated by Django 3.2.25 on 2026-10-18 14:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_messaging_dialog_support', '0019_dialogvariable_smds_variable_latest_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='launchkeyword',
+            name='match_mode',
+            field=models.CharField(choices=[('exact', 'Exact message'), ('prefix', 'Message starts with keyword'), ('contains', 'Message contains keyword'), ('token', 'Message contains keyword as a whole word'), ('regex', 'Regular expression (searched anywhere in message)')], default='exact', max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='launchkeyword',
+            name='keyword',
+            field=models.CharField(help_text='Matched according to the match mode. Use "*" as a catch-all.', max_length=256),
+        ),
+    ]
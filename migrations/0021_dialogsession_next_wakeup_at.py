@@ -0,0 +1,23 @@
+# pylint: skip-file
+# Generated by Django 3.2.25 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_messaging_dialog_support', '0020_launchkeyword_match_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dialogsession',
+            name='next_wakeup_at',
+            field=models.DateTimeField(blank=True, help_text='Earliest time the session needs nudging. Empty sessions are nudged on every pass.', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='dialogsession',
+            index=models.Index(condition=models.Q(('finished', None)), fields=['next_wakeup_at'], name='smds_session_wakeup_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# pylint: skip-file
+# Generated by Django 3.2.25 on 2026-10-18 16:40
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_media_urls(apps, schema_editor):
+    MediaCacheEntry = apps.get_model('simple_messaging_dialog_support', 'MediaCacheEntry')
+
+    for entry in MediaCacheEntry.objects.all():
+        entry.url_hash = hashlib.sha256(entry.url.encode('utf-8')).hexdigest()
+        entry.save(update_fields=['url_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_messaging_dialog_support', '0021_dialogsession_next_wakeup_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediacacheentry',
+            name='url_hash',
+            field=models.CharField(db_index=True, default='', help_text='SHA-256 of the URL, used for lookups since URLs may be too long to index.', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='mediacacheentry',
+            name='url',
+            field=models.CharField(max_length=4096),
+        ),
+        migrations.RunPython(hash_media_urls, migrations.RunPython.noop),
+    ]
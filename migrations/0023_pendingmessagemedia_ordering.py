@@ -0,0 +1,29 @@
+# pylint: skip-file
+# Generated by Django 3.2.25 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_messaging_dialog_support', '0022_mediacacheentry_url_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingmessagemedia',
+            name='lookup_hash',
+            field=models.CharField(blank=True, db_index=True, help_text='Destination hash - held messages to a destination are released in order.', max_length=1024, null=True),
+        ),
+        migrations.AddField(
+            model_name='pendingmessagemedia',
+            name='ready',
+            field=models.BooleanField(default=False, help_text='Media attached (or given up on) - waiting for earlier messages to be released.'),
+        ),
+        migrations.AlterField(
+            model_name='pendingmessagemedia',
+            name='media_url',
+            field=models.CharField(blank=True, help_text='Empty for messages only held behind earlier media.', max_length=4096),
+        ),
+    ]
@@ -6,37 +6,24 @@ from __future__ import unicode_literals, print_function
 from builtins import str # pylint: disable=redefined-builtin
 
 import datetime
-import hashlib
-import errno
-import importlib
 import logging
-import mimetypes
+import re
 import json
-import os
-import tempfile
-import time
 import traceback
 
-from contextlib import contextmanager
-
 try:
     from collections import UserDict
 except ImportError:
     from UserDict import UserDict
 
-import requests
-
 from six import python_2_unicode_compatible
-from six.moves import urllib
 
 from django.conf import settings
-from django.core.files.base import ContentFile
-from django.core.management import call_command
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
 from django.db.models import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from django.template.defaultfilters import slugify
 from django.utils import timezone
 
 try:
@@ -47,50 +34,26 @@ except ImportError:
 from django_dialog_engine.dialog import DialogError
 from django_dialog_engine.models import Dialog, DialogScript, apply_template
 
-from simple_messaging.models import IncomingMessage, OutgoingMessage, OutgoingMessageMedia, encrypt_value, decrypt_value
-
-class LockTimeoutError(Exception):
-    pass
-
-@contextmanager
-def advisory_lock(lock_name, timeout=None):
-    start_time = None
-
-    if timeout is not None:
-        start_time = timezone.now()
-
-    host_prefix = slugify(settings.ALLOWED_HOSTS[0])
-
-    tmp_dir = tempfile.gettempdir()
-
-    if hasattr(settings, 'QUICKSILVER_LOCK_DIR'):
-        tmp_dir = settings.QUICKSILVER_LOCK_DIR
-
-    file_path = '%s/%s_%s.lock' % (tmp_dir, host_prefix, lock_name)
+from simple_messaging.models import IncomingMessage, OutgoingMessage, encrypt_value
 
-    while os.path.exists(file_path):
-        if start_time is not None:
-            elapsed = timezone.now() - start_time
+from .decrypt_cache import cached_decrypt_value
+from .dispatch import request_send_flush
+from .hooks import fetch_hooks
+from .keyword_patterns import combinable_keyword_pattern
+from .locks import advisory_lock, LockTimeoutError # pylint: disable=unused-import
+from .managers import DialogAlertManager, DialogSessionManager, DialogVariableManager, generate_lookup_hash, variable_sender_query
 
-            if elapsed.total_seconds() > timeout:
-                raise LockTimeoutError('Timeout reached acquiring lock for %s (%f seconds)' % (lock_name, timeout))
+LATEST_VARIABLES_SNAPSHOT_KEY = '__smds_variables'
 
-        time.sleep(0.1)
+SESSION_STATE_FIELDS = ['last_updated', 'finished', 'next_wakeup_at']
 
-    with open(file_path, 'ab'):     # Create file if does not exist
-        os.utime(file_path, None)  # Set access/modified times to now
-
-    try:
-        yield file_path
-    finally:
-        try:
-            os.remove(file_path)
-        except EnvironmentError as error:
-            if error.errno != errno.ENOENT:
-                raise
+SESSION_SNAPSHOT_FIELDS = ['latest_variables', 'last_variable_update']
 
 class DialogSession(models.Model):
+    objects = DialogSessionManager()
+
     destination = models.CharField(max_length=256)
+    lookup_hash = models.CharField(max_length=1024, null=True, blank=True, db_index=True)
     dialog = models.ForeignKey(Dialog, related_name='dialog_sessions', null=True, on_delete=models.SET_NULL)
 
     started = models.DateTimeField()
@@ -102,7 +65,14 @@ class DialogSession(models.Model):
 
     transmission_channel = models.CharField(max_length=256, null=True, blank=True)
 
-    def process_response(self, response, extras=None, transmission_extras=None, send_messages=True, logger=None): # pylint: disable=too-many-branches, too-many-statements, too-many-locals, too-many-arguments
+    next_wakeup_at = models.DateTimeField(null=True, blank=True, help_text='Earliest time the session needs nudging. Empty sessions are nudged on every pass.')
+
+    class Meta: # pylint: disable=too-few-public-methods
+        indexes = [
+            models.Index(fields=['next_wakeup_at'], condition=Q(finished=None), name='smds_session_wakeup_idx'),
+        ]
+
+    def process_response(self, response, extras=None, transmission_extras=None, send_messages=True, logger=None): # pylint: disable=too-many-arguments
         if self.dialog is None:
             return
 
@@ -111,11 +81,9 @@ class DialogSession(models.Model):
 
         cache_key = 'dialog_session_processing_%s' % self.pk
 
-        nudge_after = False
+        max_steps = getattr(settings, 'SIMPLE_MESSAGING_DIALOG_MAX_STEPS', 50)
 
         with advisory_lock(cache_key):
-            message = None
-
             if transmission_extras is None:
                 transmission_extras = {}
 
@@ -125,283 +93,382 @@ class DialogSession(models.Model):
             else:
                 transmission_extras['message_channel'] = self.transmission_channel
 
-            try:
-                if isinstance(response, str):
-                    message = response
-                elif response is not None:
-                    message = response.message
+            if extras is None:
+                extras = {}
 
-                if extras is None:
-                    extras = {}
-            except: # pylint: disable=bare-except
-                traceback.print_exc()
+            for fetch_destination_variables in fetch_hooks('fetch_destination_variables'):
+                dest_variables = fetch_destination_variables(self.current_destination())
 
-            for app in settings.INSTALLED_APPS:
-                try:
-                    app_dialog_api = importlib.import_module(app + '.dialog_api')
+                if dest_variables is not None:
+                    extras.update(dest_variables)
 
-                    dest_variables = app_dialog_api.fetch_destination_variables(self.current_destination())
+            # Advance the dialog to its next wait point under a single lock, reusing the extras and
+            # only re-reading the variable snapshot after actions that may have written to it.
 
-                    if dest_variables is not None:
-                        extras.update(dest_variables)
-                except ImportError:
-                    pass
-                except AttributeError:
-                    pass
+            steps = 0
+            nudge_after = True
+            refresh_variables = True
+            last_actions = None
 
-            last_message = None
+            while nudge_after:
+                if steps >= max_steps:
+                    logger.warning('Session %s reached %s steps - remaining steps deferred to the next nudge.', self.pk, max_steps)
 
-            if message is not None:
-                last_message = {
-                    'value': message,
-                    'media': []
-                }
+                    break
 
-                if isinstance(response, IncomingMessage):
-                    try:
-                        for media_file in response.media.all():
-                            last_message['media'].append({
-                                'type': media_file.content_type,
-                                'size': media_file.content_file.size,
-                                'url': '%s%s' % (settings.SITE_URL, media_file.content_file.url),
-                                'identifier': 'simple_messaging.IncomingMessageMedia.%s' % media_file.pk,
-                            })
-                    except: # pylint: disable=bare-except
-                        logger.error(traceback.format_exc())
+                nudge_after, refresh_variables, actions = self.process_step(response, extras, transmission_extras, refresh_variables, logger)
 
-                if isinstance(last_message['value'], DialogVariableWrapper):
-                    last_message = last_message['value'].storage
+                last_actions = actions if actions is not None else last_actions
 
-                print('[last_message]: %s -- %s' % (last_message, type(last_message)))
+                response = None
+                steps += 1
 
-                variable_value = 'json:%s' % json.dumps(last_message)
+                logger.debug('Needs extra nudge? %s', nudge_after)
 
-                variable = DialogVariable.objects.create(sender=self.current_destination(), dialog_key=self.dialog.key, key='last_message', value=variable_value, date_set=timezone.now())
-                variable.encrypt_sender()
+            self.schedule_wakeup(last_actions, steps_remaining=nudge_after)
 
-                message = variable.fetch_value()
+            # Variable snapshot updates written by hooks above are persisted separately - leave them in place.
 
-            extras.update(self.fetch_latest_variables())
+            self.save(update_fields=SESSION_STATE_FIELDS)
 
-            message_str = None
+            logger.debug('Finished dialog? %s (%s steps)', self.finished, steps)
 
-            if message is not None:
-                message_str = str(message)
+        if send_messages:
+            request_send_flush()
 
-            extras_updates = {}
+        logger.debug('Session response finished processing.')
 
-            # We NEED the dialog variable wrappers past this point.
-            # for key, value in extras.items():
-            #     if isinstance(value, DialogVariableWrapper):
-            #         extras_updates[key] = value.fetch_value()
+    def process_step(self, response, extras, transmission_extras, refresh_variables, logger): # pylint: disable=too-many-branches, too-many-statements, too-many-locals, too-many-arguments
+        message = None
 
-            extras.update(extras_updates)
+        nudge_after = False
 
-            actions = self.dialog.process(message_str, extras=extras, logger=logger)
+        variables_changed = False
 
-            logger.debug('Updating destination variables...')
+        try:
+            if isinstance(response, str):
+                message = response
+            elif response is not None:
+                message = response.message
+        except: # pylint: disable=bare-except
+            traceback.print_exc()
+
+        last_message = None
+
+        if message is not None:
+            last_message = {
+                'value': message,
+                'media': []
+            }
 
-            for app in settings.INSTALLED_APPS:
+            if isinstance(response, IncomingMessage):
                 try:
-                    app_dialog_api = importlib.import_module(app + '.dialog_api')
+                    for media_file in response.media.all():
+                        last_message['media'].append({
+                            'type': media_file.content_type,
+                            'size': media_file.content_file.size,
+                            'url': '%s%s' % (settings.SITE_URL, media_file.content_file.url),
+                            'identifier': 'simple_messaging.IncomingMessageMedia.%s' % media_file.pk,
+                        })
+                except: # pylint: disable=bare-except
+                    logger.error(traceback.format_exc())
+
+            if isinstance(last_message['value'], DialogVariableWrapper):
+                last_message = last_message['value'].storage
+
+            print('[last_message]: %s -- %s' % (last_message, type(last_message)))
+
+            variable_value = 'json:%s' % json.dumps(last_message)
+
+            variable = DialogVariable.objects.create_encrypted(sender=self.current_destination(), dialog_key=self.dialog.key, key='last_message', value=variable_value, date_set=timezone.now()) # Snapshot updated by record_dialog_variable
 
-                    app_dialog_api.update_destination_variables(self.current_destination(), extras)
-                    logger.debug('Updated destination variables in app : %s', app)
+            message = variable.fetch_value()
 
-                except ImportError:
-                    pass
-                except AttributeError:
-                    pass
+            refresh_variables = True
 
-            logger.debug('Finished updating destination variables.')
+        if refresh_variables:
+            extras.update(self.fetch_latest_variables())
+
+        message_str = None
+
+        if message is not None:
+            message_str = str(message)
+
+        extras_updates = {}
+
+        # We NEED the dialog variable wrappers past this point.
+        # for key, value in extras.items():
+        #     if isinstance(value, DialogVariableWrapper):
+        #         extras_updates[key] = value.fetch_value()
 
-            logger.debug('Session procesing dialog actions: %s', actions)
+        extras.update(extras_updates)
 
-            if actions is not None: # pylint: disable=too-many-nested-blocks
-                self.last_updated = timezone.now()
+        actions = self.dialog.process(message_str, extras=extras, logger=logger)
 
-                actions_start = timezone.now()
+        logger.debug('Updating destination variables...')
 
-                for action in actions: # pylint: disable=unused-variable
-                    logger.debug('Session processing action: %s', action)
+        for update_destination_variables in fetch_hooks('update_destination_variables'):
+            update_destination_variables(self.current_destination(), extras)
+            logger.debug('Updated destination variables in app : %s', update_destination_variables.__module__)
+
+        logger.debug('Finished updating destination variables.')
+
+        logger.debug('Session procesing dialog actions: %s', actions)
+
+        if actions is not None: # pylint: disable=too-many-nested-blocks
+            self.last_updated = timezone.now()
 
-                    if 'type' in action:
-                        if action['type'] == 'wait-for-input':
-                            # Do nothing - input will come in via HTTP views...
-                            pass
-                        elif action['type'] == 'echo':
-                            rendered_message = apply_template(action['message'], self.dialog.metadata)
+            actions_start = timezone.now()
 
-                            delay = action.get('delay', 0)
+            for action in actions: # pylint: disable=unused-variable
+                logger.debug('Session processing action: %s', action)
 
-                            # template = Template('{% load simple_messaging_dialog_support %}' + str())
+                if 'type' in action:
+                    if action['type'] == 'wait-for-input':
+                        # Do nothing - input will come in via HTTP views...
+                        pass
+                    elif action['type'] == 'echo':
+                        rendered_message = apply_template(action['message'], self.dialog.metadata)
 
-                            # rendered_message = template.render(Context())
+                        delay = action.get('delay', 0)
 
-                            message_metadata = {
-                                'dialog_metadata': self.dialog.metadata
-                            }
+                        # template = Template('{% load simple_messaging_dialog_support %}' + str())
 
-                            when = actions_start + datetime.timedelta(seconds=delay)
+                        # rendered_message = template.render(Context())
 
+                        message_metadata = {
+                            'dialog_metadata': self.dialog.metadata
+                        }
+
+                        when = actions_start + datetime.timedelta(seconds=delay)
+
+                        media_url = action.get('media_url', None)
+
+                        from .media_queue import destination_has_pending_media, held_send_date, hold_message, queue_media # pylint: disable=import-outside-toplevel, cyclic-import
+
+                        if media_url is None and destination_has_pending_media(self.lookup_hash) is False:
                             message = OutgoingMessage.objects.create(destination=self.destination, send_date=when, message=rendered_message, message_metadata=json.dumps(message_metadata, indent=2), transmission_metadata=json.dumps(transmission_extras, indent=2))
                             message.encrypt_destination()
+                        else:
+                            # Held until the media worker attaches the file and restores the send date. Messages
+                            # behind pending media are held too, so they can't overtake it.
+
+                            message = OutgoingMessage.objects.create(destination=self.destination, send_date=held_send_date(when), message=rendered_message, message_metadata=json.dumps(message_metadata, indent=2), transmission_metadata=json.dumps(transmission_extras, indent=2))
+                            message.encrypt_destination()
+
+                            if media_url is None:
+                                hold_message(message, when, self.lookup_hash)
+                            else:
+                                queue_media(message, media_url, when, lookup_hash=self.lookup_hash)
+
+                        nudge_after = True
+                    elif action['type'] == 'pause':
+                        # Do nothing - pause will conclude in a subsequent call
+                        nudge_after = False
+                    elif action['type'] == 'store-value':
+                        to_store = action['value']
 
-                            media_url = action.get('media_url', None)
+                        if isinstance(to_store, UserDict):
+                            to_store = to_store.fetch_value()
 
-                            if media_url is not None:
-                                response = requests.get(media_url, timeout=300)
+                        for store_value in fetch_hooks('store_value'):
+                            if last_message is not None:
+                                if to_store == last_message.get('value', None):
+                                    to_store = last_message
 
-                                if response.status_code == 200:
-                                    content_type = response.headers['content-type']
+                            store_value(self.current_destination(), self.dialog.key, action['key'], to_store)
 
-                                    parsed = urllib.parse.urlparse(media_url)
+                        variables_changed = True
 
-                                    filename = parsed.path.split('/')[-1]
+                        nudge_after = True
+                    elif action['type'] == 'update-value':
+                        for update_value in fetch_hooks('update_value'):
+                            update_value(self.current_destination(), self.dialog.key, action['key'], action['value'], action['operation'], action['replacement'])
 
-                                    file_extension = mimetypes.guess_extension(content_type)
+                        variables_changed = True
 
-                                    if filename.endswith(file_extension) is False:
-                                        filename = '%s.%s' % (filename, file_extension)
+                        nudge_after = True
+                    elif action['type'] == 'external-choice':
+                        pass # Do nothing - waiting for external choice to be made...
 
-                                    media_obj = OutgoingMessageMedia.objects.create(message=message, content_type=content_type)
+                    elif action['type'] == 'alert' or action['type'] == 'raise-alert':
+                        now = timezone.now()
 
-                                    media_obj.content_file.save(filename, ContentFile(response.content))
+                        sender = self.current_destination()
 
-                                    media_obj.save()
+                        alert = DialogAlert.objects.create_encrypted(sender=sender, dialog=self.dialog, message=action['message'], added=now, last_updated=now)
 
-                            nudge_after = True
-                        elif action['type'] == 'pause':
-                            # Do nothing - pause will conclude in a subsequent call
-                            nudge_after = False
-                        elif action['type'] == 'store-value':
-                            to_store = action['value']
+                        for message in IncomingMessage.objects.all().order_by('-receive_date'):
+                            if message.current_sender() == sender:
 
-                            if isinstance(to_store, UserDict):
-                                to_store = to_store.fetch_value()
+                                if alert.metadata is None:
+                                    alert.metadata = {}
 
-                            for app in settings.INSTALLED_APPS:
-                                try:
-                                    app_dialog_api = importlib.import_module(app + '.dialog_api')
+                                alert.metadata['last_incoming_message_pk'] = '%s' % message.pk
+                                alert.save()
 
-                                    if last_message is not None:
-                                        if to_store == last_message.get('value', None):
-                                            to_store = last_message
+                                break
 
-                                    app_dialog_api.store_value(self.current_destination(), self.dialog.key, action['key'], to_store)
-                                except ImportError:
-                                    pass
-                                except AttributeError:
-                                    pass
+                        for handle_dialog_alert in fetch_hooks('handle_dialog_alert'):
+                            handle_dialog_alert(alert)
 
-                            nudge_after = True
-                        elif action['type'] == 'update-value':
-                            for app in settings.INSTALLED_APPS:
-                                try:
-                                    app_dialog_api = importlib.import_module(app + '.dialog_api')
+                        nudge_after = True
+                    elif action['type'] == 'start-new-session':
+                        script_id = action.get('script_id', None)
 
-                                    app_dialog_api.update_value(self.current_destination(), self.dialog.key, action['key'], action['value'], action['operation'], action['replacement'])
-                                except ImportError:
-                                    pass
-                                except AttributeError:
-                                    pass
+                        if script_id is not None:
+                            transmission_metadata = {}
 
-                            nudge_after = True
-                        elif action['type'] == 'external-choice':
-                            pass # Do nothing - waiting for external choice to be made...
+                            if (self.transmission_channel in (None, '',)) is False:
+                                transmission_metadata['message_channel'] = self.transmission_channel
 
-                        elif action['type'] == 'alert' or action['type'] == 'raise-alert':
-                            now = timezone.now()
+                            OutgoingMessage.objects.create(destination=self.destination, message='dialog:%s' % script_id, send_date=timezone.now(), transmission_metadata=json.dumps(transmission_metadata, indent=2))
 
-                            sender = self.current_destination()
+                            if self.dialog.is_active():
+                                self.dialog.finish(finish_reason='start_new_dialog')
+                                self.last_updated = timezone.now()
+                                self.save(update_fields=SESSION_STATE_FIELDS)
+                    else:
+                        custom_action_found = False
 
-                            alert = DialogAlert.objects.create(sender=sender, dialog=self.dialog, message=action['message'], added=now, last_updated=now)
-                            alert.encrypt_sender()
+                        for execute_dialog_action in fetch_hooks('execute_dialog_action'):
+                            if custom_action_found is False:
+                                custom_action_found = execute_dialog_action(self.current_destination(), extras, action)
 
-                            for message in IncomingMessage.objects.all().order_by('-receive_date'):
-                                if message.current_sender() == sender:
+                        variables_changed = True # Custom actions may write variables
 
-                                    if alert.metadata is None:
-                                        alert.metadata = {}
+                        if custom_action_found is False:
+                            raise DialogError('Unknown action: %s' % json.dumps(action))
+                else:
+                    raise DialogError('Unknown action: %s' % json.dumps(action))
 
-                                    alert.metadata['last_incoming_message_pk'] = '%s' % message.pk
-                                    alert.save()
+                logger.debug('Session processed action: %s', action)
 
-                                    break
+        if self.dialog.finished is not None:
+            self.finished = self.dialog.finished
 
-                            for app in settings.INSTALLED_APPS:
-                                try:
-                                    app_dialog_api = importlib.import_module(app + '.dialog_api')
+            nudge_after = False
 
-                                    app_dialog_api.handle_dialog_alert(alert)
-                                except ImportError:
-                                    pass
-                                except AttributeError:
-                                    pass
+        return nudge_after, variables_changed, actions
 
-                            nudge_after = True
-                        elif action['type'] == 'start-new-session':
-                            script_id = action.get('script_id', None)
+    def snapshot_wait_bounds(self):
+        # Shortest pause and timeout anywhere in the dialog (used when a wait doesn't carry its own) and the
+        # current node. None when elapsed-time interrupts may fire at any point.
 
-                            if script_id is not None:
-                                transmission_metadata = {}
+        shortest_pause = None
+        shortest_timeout = None
+        current_node = None
 
-                                if (self.transmission_channel in (None, '',)) is False:
-                                    transmission_metadata['message_channel'] = self.transmission_channel
+        current_state_id = getattr(self.dialog, 'current_state_id', None)
 
-                                OutgoingMessage.objects.create(destination=self.destination, message='dialog:%s' % script_id, send_date=timezone.now(), transmission_metadata=json.dumps(transmission_metadata, indent=2))
+        for node in self.dialog.dialog_snapshot or []:
+            if isinstance(node, dict) is False:
+                continue
 
-                                if self.dialog.is_active():
-                                    self.dialog.finish(finish_reason='start_new_dialog')
-                                    self.last_updated = timezone.now()
-                                    self.save()
-                        else:
-                            custom_action_found = False
+            if node.get('type', None) == 'time-elapsed-interrupt':
+                return None
 
-                            for app in settings.INSTALLED_APPS:
-                                if custom_action_found is False:
-                                    try:
-                                        app_dialog_api = importlib.import_module(app + '.dialog_api')
+            duration = node.get('duration', None)
+            timeout = node.get('timeout', None)
 
-                                        custom_action_found = app_dialog_api.execute_dialog_action(self.current_destination(), extras, action)
-                                    except ImportError:
-                                        pass
-                                    except AttributeError:
-                                        pass
+            if node.get('type', None) == 'pause' and isinstance(duration, (int, float,)):
+                shortest_pause = duration if shortest_pause is None else min(shortest_pause, duration)
 
-                            if custom_action_found is False:
-                                raise DialogError('Unknown action: %s' % json.dumps(action))
-                    else:
-                        raise DialogError('Unknown action: %s' % json.dumps(action))
+            if isinstance(timeout, (int, float,)):
+                shortest_timeout = timeout if shortest_timeout is None else min(shortest_timeout, timeout)
 
-                    logger.debug('Session processed action: %s', action)
+            if current_state_id is not None and node.get('id', None) == current_state_id:
+                current_node = node
 
-            if self.dialog.finished is not None:
-                self.finished = self.dialog.finished
+        return shortest_pause, shortest_timeout, current_node
 
-                nudge_after = False
+    def next_wakeup_time(self, actions, now):
+        wait_bounds = self.snapshot_wait_bounds()
 
-            self.save()
+        if wait_bounds is None:
+            return None
 
-            logger.debug('Finished dialog? %s', self.finished)
+        shortest_pause, shortest_timeout, current_node = wait_bounds
 
-            if send_messages:
-                call_command('simple_messaging_send_pending_messages', _qs_context=False)
+        if actions is None and current_node is not None:
+            actions = [current_node] # No transition this turn - still waiting on the current node
 
-        logger.debug('Needs extra nudge? %s', nudge_after)
+        # Waits run from the last transition (when the dialog last produced actions), so deadlines stay fixed
+        # across wakeups that find nothing to do. Polling covers changes made outside of inbound messages.
 
-        if nudge_after:
-            logger.debug('Giving extra nudge...')
+        wait_started = self.last_updated or now
 
-            self.process_response(None, extras=extras, transmission_extras=transmission_extras, send_messages=send_messages)
+        next_wakeup = now + datetime.timedelta(seconds=getattr(settings, 'SIMPLE_MESSAGING_DIALOG_IDLE_NUDGE_INTERVAL', 300))
 
-            logger.debug('Extra nudge complete.')
+        for action in actions or []:
+            action_type = action.get('type', None)
 
-        logger.debug('Session response finished processing.')
+            if action_type == 'pause':
+                duration = action.get('duration', shortest_pause)
+
+                if isinstance(duration, (int, float,)) is False:
+                    return None
+
+                return min(next_wakeup, wait_started + datetime.timedelta(seconds=duration))
+
+            if action_type in ('wait-for-input', 'external-choice',):
+                timeout = action.get('timeout', shortest_timeout)
+
+                if isinstance(timeout, (int, float,)):
+                    next_wakeup = min(next_wakeup, wait_started + datetime.timedelta(seconds=timeout))
+
+                if action_type == 'external-choice':
+                    next_wakeup = min(next_wakeup, now + datetime.timedelta(seconds=getattr(settings, 'SIMPLE_MESSAGING_DIALOG_EXTERNAL_CHOICE_NUDGE_INTERVAL', 10)))
+            elif action_type not in ('echo', 'store-value', 'update-value', 'alert', 'raise-alert',):
+                return None # Unknown or custom action - nudge on every pass
+
+        return next_wakeup
+
+    def schedule_wakeup(self, actions, steps_remaining=False):
+        now = timezone.now()
+
+        previous_wakeup = self.next_wakeup_at
+
+        self.next_wakeup_at = None
+
+        if steps_remaining or self.finished is not None:
+            return # Remaining steps are picked up on the next pass
+
+        next_wakeup = self.next_wakeup_time(actions, now)
+
+        # A turn that doesn't reach a new wait (such as a reply during a pause) must not push back a wakeup
+        # that is still pending.
+
+        if next_wakeup is not None and previous_wakeup is not None and now < previous_wakeup < next_wakeup:
+            next_wakeup = previous_wakeup
+
+        self.next_wakeup_at = next_wakeup
+
+    def save(self, *args, **kwargs): # pylint: disable=arguments-differ, signature-differs
+        # The variable snapshot is written under a row lock by the methods below - full saves of existing
+        # sessions leave it alone rather than writing back a stale in-memory copy.
+
+        if kwargs.get('update_fields', None) is None and self._state.adding is False and self.pk is not None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields if field.primary_key is False and (field.name in SESSION_SNAPSHOT_FIELDS) is False]
+
+        update_fields = kwargs.get('update_fields', None)
+
+        # Recomputed on every save that writes the destination, so edits made outside update_destination
+        # (such as the admin) keep the session reachable through for_destination.
+
+        if self.destination is not None and (update_fields is None or 'destination' in update_fields or self.lookup_hash in (None, '')):
+            lookup_hash = generate_lookup_hash(self.current_destination())
+
+            if update_fields is not None and lookup_hash != self.lookup_hash and ('lookup_hash' in update_fields) is False:
+                kwargs['update_fields'] = list(update_fields) + ['lookup_hash']
+
+            self.lookup_hash = lookup_hash
+
+        super(DialogSession, self).save(*args, **kwargs) # pylint: disable=super-with-arguments
 
     def current_destination(self):
         if self.destination is not None and self.destination.startswith('secret:'):
-            return decrypt_value(self.destination)
+            return cached_decrypt_value(self.destination)
 
         return self.destination
 
@@ -409,6 +476,8 @@ class DialogSession(models.Model):
         if force is False and new_destination == self.current_destination():
             return # Same as current - don't add
 
+        self.lookup_hash = generate_lookup_hash(new_destination)
+
         if hasattr(settings, 'SIMPLE_MESSAGING_SECRET_KEY'):
             encrypted_dest = encrypt_value(new_destination)
 
@@ -421,117 +490,130 @@ class DialogSession(models.Model):
     def encrypt_destination(self):
         if self.destination.startswith('secret:') is False:
             self.update_destination(self.destination, force=True)
+        elif self.lookup_hash in (None, ''):
+            self.save() # Populates lookup_hash
 
     def fetch_latest_variables(self):
-        query = Q(dialog_key=self.dialog.key)
+        snapshot = DialogSession.objects.filter(pk=self.pk).values('latest_variables', 'last_variable_update').first()
 
-        variables = {}
+        if snapshot is None or snapshot['last_variable_update'] is None:
+            self.rebuild_variable_snapshot()
+        else:
+            self.latest_variables = snapshot['latest_variables']
+            self.last_variable_update = snapshot['last_variable_update']
 
         current_destination = self.current_destination()
 
-        query = Q(lookup_hash=None)
+        wrapped_variables = {}
+
+        for key, value in self.latest_variables.get(LATEST_VARIABLES_SNAPSHOT_KEY, {}).items():
+            wrapped_variables[key] = DialogVariableWrapper(current_destination, key, value)
 
-        hash_obj = hashlib.sha256()
-        hash_obj.update(current_destination.encode('utf-8'))
+        return wrapped_variables
 
-        hash_lookup = hash_obj.hexdigest()
+    def rebuild_variable_snapshot(self):
+        current_destination = self.current_destination()
 
-        query = query | Q(lookup_hash=hash_lookup)
+        query = variable_sender_query(current_destination)
 
         query = query & Q(date_set__gte=self.started)
 
         if self.finished is not None:
             query = query & Q(date_set__lte=self.finished)
 
-        wrapped_variables = {}
+        variables = {}
 
         for variable in DialogVariable.objects.filter(query).order_by('date_set'):
             if variable.current_sender() == current_destination:
-                wrapped_variables[variable.key] = variable.fetch_value()
+                variables[variable.key] = variable.fetch_storage()
 
-                # print('variable.key[%s]: %s' % (variable.pk, variable.key))
+            if variable.lookup_hash in (None, ''):
+                variable.lookup_hash = generate_lookup_hash(variable.current_sender())
+                variable.save()
 
-                # variables[variable.key] = dict(wrapped_variables[variable.key])
+        with transaction.atomic():
+            latest_variables = DialogSession.objects.select_for_update().filter(pk=self.pk).values_list('latest_variables', flat=True).first()
 
-            if variable.lookup_hash in (None, ''):
-                new_hash_obj = hashlib.sha256()
-                new_hash_obj.update(variable.current_sender().encode('utf-8'))
+            if latest_variables is None:
+                latest_variables = {}
 
-                variable.lookup_hash = new_hash_obj.hexdigest()
-                variable.save()
+            latest_variables[LATEST_VARIABLES_SNAPSHOT_KEY] = variables
 
-#         self.latest_variables = variables
-#         self.last_variable_update = timezone.now()
-#         self.save()
+            self.latest_variables = latest_variables
+            self.last_variable_update = timezone.now()
 
-        raw_variables = dict(variables)
+            DialogSession.objects.filter(pk=self.pk).update(latest_variables=self.latest_variables, last_variable_update=self.last_variable_update)
 
-        raw_variables.update(wrapped_variables)
+    def update_variable_snapshot(self, variables):
+        with transaction.atomic():
+            snapshot = DialogSession.objects.select_for_update().filter(pk=self.pk).values('latest_variables', 'last_variable_update').first()
 
-        return raw_variables
+            if snapshot is None or snapshot['last_variable_update'] is None:
+                return # No snapshot yet - built from history on next fetch.
 
-    def add_variable(self, key, value, dialog_key=None):
-        if isinstance(value, str) is False:
-            value = 'json:%s' % json.dumps(value)
+            latest_variables = snapshot['latest_variables']
 
-        DialogVariable.objects.create(sender=self.current_destination(), dialog_key=dialog_key, key=key, value=value, date_set=timezone.now())
+            if LATEST_VARIABLES_SNAPSHOT_KEY not in latest_variables:
+                latest_variables[LATEST_VARIABLES_SNAPSHOT_KEY] = {}
 
-    def cancel_sesssion(self):
-        if self.dialog.is_active():
-            self.dialog.finish(finish_reason='user_cancelled')
-            self.last_updated = timezone.now()
-            self.save()
+            for variable in variables:
+                latest_variables[LATEST_VARIABLES_SNAPSHOT_KEY][variable.key] = variable.fetch_storage()
 
-@receiver(post_save, sender=DialogSession)
-def update_dialog_variables(sender, instance, created, raw, using, update_fields, **kwargs): # pylint: disable=too-many-arguments, too-many-locals, unused-argument, too-many-branches
-    if created is True and raw is False: # pylint: disable=too-many-nested-blocks
-        template_variables = list(DialogTemplateVariable.objects.filter(script=None))
+            self.latest_variables = latest_variables
+            self.last_variable_update = timezone.now()
 
-        script_labels = []
+            DialogSession.objects.filter(pk=self.pk).update(latest_variables=self.latest_variables, last_variable_update=self.last_variable_update)
 
-        if instance.dialog.script:
-            template_variables.extend(instance.dialog.script.template_variables.all())
+    @classmethod
+    def record_variable(cls, variable, destination=None, instance=None):
+        cls.record_variables([variable], destination=destination, instance=instance)
 
-            script_labels = instance.dialog.script.labels_list()
+    @classmethod
+    def record_variables(cls, variables, destination=None, instance=None):
+        if len(variables) == 0: # pylint: disable=len-as-condition
+            return
 
-        for variable in template_variables:
-            if (variable.key in instance.dialog.metadata) is False:
-                variable_value = str(variable.fetch_value())
+        if destination is None:
+            destination = variables[0].current_sender()
 
-                values = variable_value.strip().splitlines()
+        for session in cls.objects.for_destination(destination).filter(finished=None):
+            if session.current_destination() == destination:
+                if instance is not None and instance.pk == session.pk:
+                    session = instance
 
-                if len(values) == 1:
-                    instance.dialog.metadata[variable.key] = variable_value
-                else:
-                    for raw_value in values:
-                        value_tokens = raw_value.split('|')
+                session.update_variable_snapshot(variables)
 
-                        if len(value_tokens) == 1:
-                            instance.dialog.metadata[variable.key] = value_tokens[0]
-                        else:
-                            tag = value_tokens[0]
+    def add_variable(self, key, value, dialog_key=None):
+        self.add_variables({key: value}, dialog_key=dialog_key)
 
-                            if tag in script_labels:
-                                instance.dialog.metadata[variable.key] = value_tokens[1]
+    def add_variables(self, values, dialog_key=None):
+        now = timezone.now()
 
-                    if instance.dialog.metadata.get(variable.key, None) is None:
-                        value_tokens = values[0].split('|')
+        destination = self.current_destination()
 
-                        instance.dialog.metadata[variable.key] = value_tokens[-1]
+        to_create = []
 
-        for app in settings.INSTALLED_APPS:
-            try:
-                app_dialog_api = importlib.import_module(app + '.dialog_api')
+        for key, value in values.items():
+            if isinstance(value, str) is False:
+                value = 'json:%s' % json.dumps(value)
 
-                updates = app_dialog_api.fetch_dialog_metadata(instance.current_destination(), instance.dialog)
+            to_create.append({
+                'sender': destination,
+                'dialog_key': dialog_key,
+                'key': key,
+                'value': value,
+                'date_set': now,
+            })
 
-                instance.dialog.metadata.update(updates)
-            except ImportError:
-                pass
-            except AttributeError:
-                pass
+        variables = DialogVariable.objects.bulk_create_encrypted(to_create)
 
-        instance.dialog.save()
+        DialogSession.record_variables(variables, destination=destination, instance=self)
+
+    def cancel_sesssion(self):
+        if self.dialog.is_active():
+            self.dialog.finish(finish_reason='user_cancelled')
+            self.last_updated = timezone.now()
+            self.save(update_fields=SESSION_STATE_FIELDS)
 
 class DialogVariableWrapper(): # pylint: disable=old-style-class, super-on-old-class
     def __init__(self, sender, name, value):
@@ -625,6 +707,8 @@ class DialogVariableWrapper(): # pylint: disable=old-style-class, super-on-old-c
 
 @python_2_unicode_compatible
 class DialogVariable(models.Model):
+    objects = DialogVariableManager()
+
     sender = models.CharField(max_length=256)
     dialog_key = models.CharField(max_length=256, null=True, blank=True, db_index=True)
 
@@ -635,7 +719,16 @@ class DialogVariable(models.Model):
 
     lookup_hash = models.CharField(max_length=1024, null=True, blank=True)
 
-    def fetch_value(self, unwrap=False):
+    def save(self, *args, **kwargs): # pylint: disable=arguments-differ, signature-differs
+        if self.lookup_hash in (None, '') and self.sender is not None:
+            self.lookup_hash = generate_lookup_hash(self.current_sender())
+
+            if kwargs.get('update_fields', None) is not None:
+                kwargs['update_fields'] = list(kwargs['update_fields']) + ['lookup_hash']
+
+        super(DialogVariable, self).save(*args, **kwargs) # pylint: disable=super-with-arguments
+
+    def fetch_storage(self):
         variable_value = self.value
 
         if isinstance(variable_value, str) and variable_value.startswith('json:'):
@@ -646,6 +739,11 @@ class DialogVariable(models.Model):
                 'value': variable_value
             }
 
+        return variable_value
+
+    def fetch_value(self, unwrap=False):
+        variable_value = self.fetch_storage()
+
         if unwrap:
             if isinstance(variable_value, dict):
                 variable_value['__smds_unwrapped'] = True
@@ -664,7 +762,7 @@ class DialogVariable(models.Model):
 
     def current_sender(self):
         if self.sender is not None and self.sender.startswith('secret:'):
-            return decrypt_value(self.sender)
+            return cached_decrypt_value(self.sender)
 
         return self.sender
 
@@ -688,6 +786,16 @@ class DialogVariable(models.Model):
     def __str__(self):
         return '%s.%s[%s] = %s (%s)' % (self.dialog_key, self.key, self.current_sender(), self.fetch_value(), self.date_set)
 
+    class Meta: # pylint: disable=too-few-public-methods
+        indexes = [
+            models.Index(fields=['lookup_hash', 'dialog_key', 'key', 'date_set'], name='smds_variable_latest_idx'),
+        ]
+
+@receiver(post_save, sender=DialogVariable)
+def record_dialog_variable(sender, instance, created, raw, **kwargs): # pylint: disable=unused-argument
+    if created is True and raw is False:
+        DialogSession.record_variable(instance) # Variables created anywhere reach open sessions' snapshots
+
 @python_2_unicode_compatible
 class DialogTemplateVariable(models.Model):
     script = models.ForeignKey(DialogScript, related_name='template_variables', null=True, blank=True, on_delete=models.SET_NULL)
@@ -710,8 +818,38 @@ class DialogTemplateVariable(models.Model):
     def __str__(self):
         return '[%s] %s = %s' % (self.script, self.key, self.fetch_value())
 
+    def resolve_value(self, script_labels):
+        variable_value = str(self.fetch_value())
+
+        values = variable_value.strip().splitlines()
+
+        if len(values) == 1:
+            return variable_value
+
+        resolved = None
+
+        for raw_value in values:
+            value_tokens = raw_value.split('|')
+
+            if len(value_tokens) == 1:
+                resolved = value_tokens[0]
+            else:
+                tag = value_tokens[0]
+
+                if tag in script_labels:
+                    resolved = value_tokens[1]
+
+        if resolved is None:
+            value_tokens = values[0].split('|')
+
+            resolved = value_tokens[-1]
+
+        return resolved
+
 @python_2_unicode_compatible
 class DialogAlert(models.Model):
+    objects = DialogAlertManager()
+
     sender = models.CharField(max_length=256)
     dialog = models.ForeignKey(Dialog, related_name='dialog_alerts', null=True, on_delete=models.SET_NULL)
 
@@ -727,7 +865,7 @@ class DialogAlert(models.Model):
 
     def current_sender(self):
         if self.sender is not None and self.sender.startswith('secret:'):
-            return decrypt_value(self.sender)
+            return cached_decrypt_value(self.sender)
 
         return self.sender
 
@@ -766,11 +904,66 @@ class DialogAlert(models.Model):
 
         self.save()
 
+LAUNCH_KEYWORD_MATCH_MODES = (
+    ('exact', 'Exact message',),
+    ('prefix', 'Message starts with keyword',),
+    ('contains', 'Message contains keyword',),
+    ('token', 'Message contains keyword as a whole word',),
+    ('regex', 'Regular expression (searched anywhere in message)',),
+)
+
 class LaunchKeyword(models.Model):
-    keyword = models.CharField(max_length=256, help_text='Uses literal string matching (not regexp). Use "*" as a catch-all.')
+    keyword = models.CharField(max_length=256, help_text='Matched according to the match mode. Use "*" as a catch-all.')
     dialog_script = models.ForeignKey(DialogScript, related_name='launch_keywords', null=True, on_delete=models.SET_NULL)
     case_sensitive = models.BooleanField(default=False)
 
+    match_mode = models.CharField(max_length=64, choices=LAUNCH_KEYWORD_MATCH_MODES, default='exact')
+
     priority = models.IntegerField(default=0, help_text='Higher priority keywords are evaluated first.')
 
     launch_condition = models.TextField(null=True, blank=True, help_text='Evaluated by .dialog_api.launch_keyword_enabled functions.')
+
+    def clean(self):
+        if self.match_mode == 'regex' and self.keyword != '*':
+            try:
+                combinable_keyword_pattern(self) # Checked as it will be compiled into the shared matcher
+            except re.error as exc:
+                raise ValidationError({'keyword': 'Invalid regular expression: %s' % exc}) # pylint: disable=raise-missing-from
+
+@python_2_unicode_compatible
+class MediaCacheEntry(models.Model):
+    url = models.CharField(max_length=4096)
+    url_hash = models.CharField(max_length=64, db_index=True, help_text='SHA-256 of the URL, used for lookups since URLs may be too long to index.')
+    content_hash = models.CharField(max_length=64, db_index=True)
+    content_type = models.CharField(max_length=256)
+    content_file = models.FileField(upload_to='simple_messaging_dialog_support_media_cache', max_length=1024)
+    size = models.BigIntegerField(default=0)
+
+    etag = models.CharField(max_length=1024, null=True, blank=True)
+    last_modified = models.CharField(max_length=256, null=True, blank=True)
+
+    fetched = models.DateTimeField()
+    last_validated = models.DateTimeField()
+    last_used = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return '%s (%s)' % (self.url, self.content_hash)
+
+    def save(self, *args, **kwargs): # pylint: disable=arguments-differ, signature-differs
+        self.url_hash = generate_lookup_hash(self.url)
+
+        super(MediaCacheEntry, self).save(*args, **kwargs) # pylint: disable=super-with-arguments
+
+class PendingMessageMedia(models.Model):
+    message = models.ForeignKey(OutgoingMessage, related_name='pending_dialog_media', on_delete=models.CASCADE)
+    media_url = models.CharField(max_length=4096, blank=True, help_text='Empty for messages only held behind earlier media.')
+    lookup_hash = models.CharField(max_length=1024, null=True, blank=True, db_index=True, help_text='Destination hash - held messages to a destination are released in order.')
+    ready = models.BooleanField(default=False, help_text='Media attached (or given up on) - waiting for earlier messages to be released.')
+
+    send_date = models.DateTimeField(help_text='Send date to restore once media is attached.')
+
+    added = models.DateTimeField()
+    claimed = models.DateTimeField(null=True, blank=True)
+
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
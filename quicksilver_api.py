@@ -2,4 +2,5 @@ def quicksilver_tasks():
     return [
         ('simple_messaging_send_pending_messages', '--no-color', 5,),
         ('nudge_active_sessions', '--no-color', 10,),
+        ('simple_messaging_dialog_support_fetch_pending_media', '--no-color', 15,),
     ]
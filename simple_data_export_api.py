@@ -1,20 +1,28 @@
 # pylint: disable=line-too-long, no-member
 
-import importlib
+import collections
+import datetime
+import heapq
 import io
-import hashlib
+import itertools
+import multiprocessing
+import operator
 import os
 import tempfile
 
 import pytz
 
 from django.conf import settings
+from django.db import connections
 from django.db.models import Q
 from django.utils import timezone
 
 from simple_data_export.utils import fetch_export_identifier, UnicodeWriter # pylint: disable=import-error
 
-from .models import DialogSession, DialogVariable
+from .export_formats import export_format_option, open_export_writer
+from .hooks import fetch_hooks
+from .managers import variable_hashes_complete
+from .models import DialogSession, DialogVariable, generate_lookup_hash
 
 def export_data_sources(params=None):
     if params is None:
@@ -22,7 +30,15 @@ def export_data_sources(params=None):
 
     destinations = []
 
-    for session in DialogSession.objects.all():
+    seen_hashes = set()
+
+    for session in DialogSession.objects.all().only('destination', 'lookup_hash'):
+        if session.lookup_hash is not None:
+            if session.lookup_hash in seen_hashes:
+                continue # Already decrypted a session for this destination
+
+            seen_hashes.add(session.lookup_hash)
+
         destination = session.current_destination()
 
         if (destination in destinations) is False:
@@ -36,224 +52,390 @@ def export_data_types():
         ('simple_messaging_dialog_support.dialog_variable_timeline', 'Dialog Variable Timeline',),
     ]
 
-def compile_data_export(data_type, data_sources, start_time=None, end_time=None, custom_parameters=None): # pylint: disable=too-many-locals, unused-argument, too-many-branches, too-many-statements
-    here_tz = pytz.timezone(settings.TIME_ZONE)
+def export_chunk_size():
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_EXPORT_CHUNK_SIZE', 2000)
+
+def source_hash_map(data_sources):
+    hash_map = {}
+
+    for data_source in data_sources:
+        hash_map[generate_lookup_hash(data_source)] = data_source
+
+    return hash_map
+
+def timeline_source_names(data_source):
+    source_names = [data_source]
+
+    export_name = fetch_export_identifier(data_source)
+
+    if export_name != data_source:
+        source_names.append(export_name)
+
+    return source_names
+
+def export_hash_map(data_type, data_sources):
+    if data_type == 'simple_messaging_dialog_support.dialog_variable_timeline':
+        return source_hash_map([name for data_source in data_sources for name in timeline_source_names(data_source)])
+
+    return source_hash_map(data_sources)
+
+def legacy_row_hashes(queryset, fetch_address, hash_map):
+    # Rows without lookup hashes are hashed in memory (not saved - see the hash backfill commands), keeping the
+    # primary keys of the ones that match an exported source.
+
+    row_hashes = {}
+
+    for row in queryset.iterator(chunk_size=export_chunk_size()):
+        lookup_hash = generate_lookup_hash(fetch_address(row))
+
+        if lookup_hash in hash_map:
+            row_hashes[row.pk] = lookup_hash
+
+    return row_hashes
+
+def resolve_legacy_hashes(data_type, hash_map):
+    # Decrypts the unhashed sessions and variables once per export - (session hashes, variable hashes) by
+    # primary key - so parallel slices and per-source passes don't each rescan them.
+
+    session_hashes = {}
+    variable_hashes = {}
 
     if data_type == 'simple_messaging_dialog_support.dialog_variables':
-        filename = tempfile.gettempdir() + os.path.sep + 'simple_messaging_dialog_support.dialog_variables.txt'
+        sessions = DialogSession.objects.exclude(finished=None).exclude(dialog=None).filter(lookup_hash=None).only('destination')
 
-        print('simple_messaging_dialog_support.dialog_variables: 1')
+        session_hashes = legacy_row_hashes(sessions, lambda session: session.current_destination(), hash_map)
 
-        with io.open(filename, 'wb') as outfile:
-            print('simple_messaging_dialog_support.dialog_variables: 1.1')
+    if variable_hashes_complete() is False:
+        variables = DialogVariable.objects.filter(lookup_hash=None).only('sender')
 
-            writer = UnicodeWriter(outfile, delimiter='\t')
+        variable_hashes = legacy_row_hashes(variables, lambda variable: variable.current_sender(), hash_map)
 
-            variables = [
-                'Destination',
-                'Dialog',
-                'Started',
-                'Finished',
-                'Cancelled',
-            ]
+    return session_hashes, variable_hashes
 
-            dialog_variables = []
+def matching_legacy_hashes(legacy_hashes, hash_map):
+    return tuple({pk: lookup_hash for pk, lookup_hash in row_hashes.items() if lookup_hash in hash_map} for row_hashes in legacy_hashes)
 
-            print('simple_messaging_dialog_support.dialog_variables: 1.2')
+def legacy_export_rows(queryset, row_hashes, hash_map, sort_key):
+    # Rows without lookup hashes can't be ordered by the database, so the ones resolved above are sorted
+    # alongside the streamed rows.
 
-            for app in settings.INSTALLED_APPS:
-                try:
-                    app_dialog_api = importlib.import_module(app + '.dialog_api')
+    rows = []
 
-                    specific_variables = app_dialog_api.dialog_export_variables(None)
+    row_pks = [pk for pk, lookup_hash in row_hashes.items() if lookup_hash in hash_map]
 
-                    if specific_variables is not None:
-                        dialog_variables.extend(specific_variables)
-                except ImportError:
-                    pass
-                except AttributeError:
-                    pass
+    if row_pks:
+        for row in queryset.filter(lookup_hash=None, pk__in=row_pks).iterator(chunk_size=export_chunk_size()):
+            row.lookup_hash = row_hashes[row.pk]
 
-            print('simple_messaging_dialog_support.dialog_variables: 1.3')
+            rows.append(row)
 
-            if len(dialog_variables) == 0: # pylint: disable=len-as-condition
-                for variable_key in DialogVariable.objects.order_by().values_list('key', flat=True).distinct():
-                    if (variable_key in dialog_variables) is False:
-                        dialog_variables.append(variable_key)
+    rows.sort(key=sort_key)
 
-            variables.extend(dialog_variables)
+    return rows
 
-            print('simple_messaging_dialog_support.dialog_variables: 1.4')
+def session_sort_key(session):
+    return (session.lookup_hash, session.started, session.pk,)
 
-            writer.writerow(variables)
+def ordered_export_sessions(hash_map, session_hashes):
+    sessions = DialogSession.objects.exclude(finished=None).exclude(dialog=None).select_related('dialog').only('destination', 'lookup_hash', 'started', 'finished', 'dialog__key', 'dialog__finish_reason')
 
-            print('simple_messaging_dialog_support.dialog_variables: 1.5')
+    hashed = sessions.filter(lookup_hash__in=list(hash_map)).order_by('lookup_hash', 'started', 'pk').iterator(chunk_size=export_chunk_size())
 
-            for session in DialogSession.objects.exclude(finished=None).order_by('started'): # pylint: disable=too-many-nested-blocks
-                destination = session.current_destination()
+    legacy = legacy_export_rows(sessions, session_hashes, hash_map, session_sort_key)
 
-                if destination in data_sources:
-                    print('simple_messaging_dialog_support.dialog_variables[%s]: 1.5.1' % destination)
+    for session in heapq.merge(hashed, legacy, key=session_sort_key):
+        session.export_source = hash_map[session.lookup_hash]
 
-                    if session.dialog is not None:
-                        print('simple_messaging_dialog_support.dialog_variables[%s]: 1.5.1.1' % destination)
+        yield session
 
-                        session_variables = {
-                            'Destination': fetch_export_identifier(destination),
-                            'Dialog': session.dialog.key,
-                            'Started': session.started.astimezone(here_tz).isoformat(),
-                            'Finished': session.finished.astimezone(here_tz).isoformat(),
-                            'Cancelled': False,
-                        }
+def ordered_export_variables(hash_map, variable_hashes, order_fields=('lookup_hash', 'date_set', 'pk',), start_time=None, end_time=None):
+    variables = DialogVariable.objects.only('sender', 'lookup_hash', 'dialog_key', 'key', 'value', 'date_set')
 
-                        if session.dialog.finish_reason in ('user_cancelled', 'dialog_cancelled', 'timed_out',):
-                            session_variables['Cancelled'] = True
+    if start_time is not None:
+        variables = variables.filter(date_set__gte=start_time)
 
-                        print('simple_messaging_dialog_support.dialog_variables[%s]: 1.5.1.2' % destination)
+    if end_time is not None:
+        variables = variables.filter(date_set__lte=end_time)
 
-                        query = Q(lookup_hash=None)
+    sort_key = operator.attrgetter(*order_fields)
 
-                        hash_obj = hashlib.sha256()
-                        hash_obj.update(destination.encode('utf-8'))
+    hashed = variables.filter(lookup_hash__in=list(hash_map)).order_by(*order_fields).iterator(chunk_size=export_chunk_size())
 
-                        hash_lookup = hash_obj.hexdigest()
+    legacy = legacy_export_rows(variables, variable_hashes, hash_map, sort_key)
 
-                        query = query | Q(lookup_hash=hash_lookup)
+    return heapq.merge(hashed, legacy, key=sort_key)
 
-                        query = query & Q(date_set__gte=session.started)
-                        query = query & Q(date_set__lte=session.finished)
+def local_isoformat(when, here_tz, offset_cache):
+    # Offsets only change on the hour, so each hour is converted through pytz once and reused.
 
-                        print('simple_messaging_dialog_support.dialog_variables[%s]: 1.5.1.3' % destination)
+    hour = when.replace(minute=0, second=0, microsecond=0)
 
-                        variable_pks = DialogVariable.objects.filter(query).order_by('date_set').values_list('pk', flat=True)
+    local_tz = offset_cache.get(hour, None)
 
-                        index = 0
+    if local_tz is None:
+        local_tz = datetime.timezone(when.astimezone(here_tz).utcoffset())
 
-                        print('simple_messaging_dialog_support.dialog_variables[%s]: 1.5.1.4 - %s' % (destination, len(variable_pks)))
+        offset_cache[hour] = local_tz
 
-                        for variable_pk in variable_pks: # in DialogVariable.objects.order_by('date_set'):
-                            if (index % 500) == 0:
-                                print('simple_messaging_dialog_support.dialog_variables[%s]: %s / %s -- %s' % (destination, index, len(variable_pks), timezone.now().isoformat()))
+    return when.astimezone(local_tz).isoformat()
 
-                            index += 1
+def add_session_variable(pending, variable):
+    value = None
 
-                            variable = DialogVariable.objects.get(pk=variable_pk)
+    for session, session_values in pending:
+        if session.started <= variable.date_set <= session.finished:
+            if value is None:
+                value = str(variable.fetch_value())
 
-                            sender = variable.current_sender()
+            session_values.setdefault(variable.key, []).append(value)
 
-                            hash_obj = hashlib.sha256()
-                            hash_obj.update(sender.encode('utf-8'))
+def export_session_variables(hash_map, legacy_hashes):
+    # Merge join of sessions and variables, both ordered by (lookup hash, time). Sessions are yielded in start
+    # order per destination once no later variable can fall inside them, keeping memory flat.
 
-                            hash_lookup = hash_obj.hexdigest()
+    session_hashes, variable_hashes = legacy_hashes
 
-                            if sender == destination:
-                                if (variable.key in session_variables) is False:
-                                    session_variables[variable.key] = []
+    variables = ordered_export_variables(hash_map, variable_hashes)
 
-                                session_variables[variable.key].append(str(variable.fetch_value()))
+    variable = next(variables, None)
 
-                            if variable.lookup_hash is None:
-                                variable.lookup_hash = hash_lookup
-                                variable.save()
+    for lookup_hash, sessions in itertools.groupby(ordered_export_sessions(hash_map, session_hashes), key=lambda session: session.lookup_hash):
+        while variable is not None and variable.lookup_hash < lookup_hash:
+            variable = next(variables, None)
 
-                        row = []
+        pending = collections.deque()
 
-                        for variable in variables:
-                            if variable in session_variables:
-                                value = session_variables[variable]
+        for session in sessions:
+            while variable is not None and variable.lookup_hash == lookup_hash and variable.date_set < session.started:
+                while pending and pending[0][0].finished < variable.date_set:
+                    yield pending.popleft()
 
-                                if isinstance(value, list):
-                                    row.append('; '.join(value))
-                                elif isinstance(value, bool):
-                                    row.append(str(value))
-                                else:
-                                    row.append(value)
-                            else:
-                                row.append('')
+                add_session_variable(pending, variable)
 
-                        writer.writerow(row)
+                variable = next(variables, None)
 
-        return filename
+            while pending and pending[0][0].finished < session.started:
+                yield pending.popleft()
 
-    if data_type == 'simple_messaging_dialog_support.dialog_variable_timeline':
-        filename = tempfile.gettempdir() + os.path.sep + 'simple_messaging_dialog_support.dialog_variables.txt'
+            pending.append((session, {},))
 
-        print('dialog_variable_timeline 1.1')
+        while variable is not None and variable.lookup_hash == lookup_hash:
+            while pending and pending[0][0].finished < variable.date_set:
+                yield pending.popleft()
+
+            add_session_variable(pending, variable)
 
-        with io.open(filename, 'wb') as outfile:
-            writer = UnicodeWriter(outfile, delimiter='\t')
+            variable = next(variables, None)
 
-            columns = [
-                'Destination',
-                'Dialog',
-                'Date Set',
-                'Key',
-                'Value',
-            ]
+        while pending:
+            yield pending.popleft()
 
-            print('dialog_variable_timeline 1.1.2')
+def write_dialog_variables_rows(writer, data_sources, columns, legacy_hashes):
+    here_tz = pytz.timezone(settings.TIME_ZONE)
 
-            writer.writerow(columns)
+    index = 0
 
-            for data_source in data_sources:
-                print('dialog_variable_timeline 1.1.2 -- %s' % data_source)
+    for session, session_values in export_session_variables(source_hash_map(data_sources), legacy_hashes):
+        if (index % 500) == 0:
+            print('simple_messaging_dialog_support.dialog_variables: %s sessions -- %s' % (index, timezone.now().isoformat()))
 
-                source_names = [data_source]
+        index += 1
 
-                export_name = fetch_export_identifier(data_source)
+        session_variables = {
+            'Destination': fetch_export_identifier(session.export_source),
+            'Dialog': session.dialog.key,
+            'Started': session.started.astimezone(here_tz).isoformat(),
+            'Finished': session.finished.astimezone(here_tz).isoformat(),
+            'Cancelled': False,
+        }
 
-                if export_name != data_source:
-                    source_names.append(export_name)
+        if session.dialog.finish_reason in ('user_cancelled', 'dialog_cancelled', 'timed_out',):
+            session_variables['Cancelled'] = True
 
-                query = Q(lookup_hash=None)
+        session_variables.update(session_values)
 
-                for source_name in source_names:
-                    hash_obj = hashlib.sha256()
-                    hash_obj.update(source_name.encode('utf-8'))
+        row = []
 
-                    hash_lookup = hash_obj.hexdigest()
+        for column in columns:
+            if column in session_variables:
+                value = session_variables[column]
 
-                    query = query | Q(lookup_hash=hash_lookup) # pylint: disable=unsupported-binary-operation
+                if isinstance(value, list):
+                    row.append('; '.join(value))
+                elif isinstance(value, bool):
+                    row.append(str(value))
+                else:
+                    row.append(value)
+            else:
+                row.append('')
 
-                variable_pks = DialogVariable.objects.filter(query).order_by('date_set').values_list('pk', flat=True)
+        writer.writerow(row)
+
+def write_timeline_rows(writer, data_sources, start_time, end_time, legacy_hashes):
+    here_tz = pytz.timezone(settings.TIME_ZONE)
 
-                print('dialog_variable_timeline 1.1.3 %s' % len(variable_pks))
+    variable_hashes = legacy_hashes[1]
 
-                index = 0
+    offset_cache = {}
 
-                for variable_pk in variable_pks: # in DialogVariable.objects.order_by('date_set'):
-                    if (index % 500) == 0:
-                        print('dialog_variable_timeline: %s / %s -- %s' % (index, len(variable_pks), timezone.now().isoformat()))
+    for data_source in data_sources:
+        print('dialog_variable_timeline 1.1.2 -- %s' % data_source)
 
-                    index += 1
+        hash_map = source_hash_map(timeline_source_names(data_source))
+
+        index = 0
+
+        for variable in ordered_export_variables(hash_map, variable_hashes, order_fields=('date_set', 'pk',), start_time=start_time, end_time=end_time):
+            if (index % 5000) == 0:
+                print('dialog_variable_timeline: %s -- %s' % (index, timezone.now().isoformat()))
+
+            index += 1
+
+            row = []
+
+            row.append(fetch_export_identifier(hash_map[variable.lookup_hash]))
+            row.append(variable.dialog_key)
+            row.append(local_isoformat(variable.date_set, here_tz, offset_cache))
+            row.append(variable.key)
+            row.append(variable.value)
+
+            writer.writerow(row)
+
+def write_export_rows(writer, task):
+    data_type, data_sources, columns, start_time, end_time, legacy_hashes = task
+
+    if data_type == 'simple_messaging_dialog_support.dialog_variables':
+        write_dialog_variables_rows(writer, data_sources, columns, legacy_hashes)
+    elif data_type == 'simple_messaging_dialog_support.dialog_variable_timeline':
+        write_timeline_rows(writer, data_sources, start_time, end_time, legacy_hashes)
 
-                    variable = DialogVariable.objects.get(pk=variable_pk)
+def export_workers():
+    return getattr(settings, 'SIMPLE_MESSAGING_DIALOG_EXPORT_WORKERS', 1)
 
-                    sender = variable.current_sender()
+def export_partial(task):
+    connections.close_all() # Never share the parent's connection across processes
 
-                    hash_obj = hashlib.sha256()
-                    hash_obj.update(sender.encode('utf-8'))
+    partial_handle, partial_path = tempfile.mkstemp(prefix='simple_messaging_dialog_support_export_', suffix='.txt')
 
-                    hash_lookup = hash_obj.hexdigest()
+    try:
+        with io.open(partial_handle, 'wb') as outfile:
+            write_export_rows(UnicodeWriter(outfile, delimiter='\t'), task)
+    finally:
+        connections.close_all()
+
+    return partial_path
+
+def export_slice_tasks(task, workers):
+    data_type, data_sources, columns, start_time, end_time, legacy_hashes = task
+
+    # Contiguous slices keep the output order - several per worker to even out destinations of different sizes.
+    # Each slice carries only the legacy rows resolved for its own sources.
+
+    slice_count = min(len(data_sources), workers * 4)
+
+    slice_size = -(-len(data_sources) // slice_count)
+
+    tasks = []
+
+    for slice_start in range(0, len(data_sources), slice_size):
+        slice_sources = data_sources[slice_start:(slice_start + slice_size)]
+
+        slice_hashes = matching_legacy_hashes(legacy_hashes, export_hash_map(data_type, slice_sources))
+
+        tasks.append((data_type, slice_sources, columns, start_time, end_time, slice_hashes,))
+
+    return tasks
+
+def write_export_rows_parallel(writer, task, workers):
+    data_type = task[0]
+
+    tasks = export_slice_tasks(task, workers)
+
+    connections.close_all()
+
+    partial_paths = []
+
+    try:
+        with multiprocessing.get_context('fork').Pool(processes=workers) as pool:
+            for partial_path in pool.imap(export_partial, tasks):
+                partial_paths.append(partial_path)
+
+                writer.append_partial(partial_path)
+
+                print('%s: merged %s / %s partial exports -- %s' % (data_type, len(partial_paths), len(tasks), timezone.now().isoformat()))
+    finally:
+        for partial_path in partial_paths:
+            os.remove(partial_path)
+
+def compile_data_export(data_type, data_sources, start_time=None, end_time=None, custom_parameters=None): # pylint: disable=too-many-locals, unused-argument, too-many-branches, too-many-statements
+    if data_type == 'simple_messaging_dialog_support.dialog_variables':
+        filename_base = tempfile.gettempdir() + os.path.sep + 'simple_messaging_dialog_support.dialog_variables'
+
+        print('simple_messaging_dialog_support.dialog_variables: 1')
+
+        columns = [
+            'Destination',
+            'Dialog',
+            'Started',
+            'Finished',
+            'Cancelled',
+        ]
+
+        dialog_variables = []
+
+        print('simple_messaging_dialog_support.dialog_variables: 1.2')
+
+        for dialog_export_variables in fetch_hooks('dialog_export_variables'):
+            specific_variables = dialog_export_variables(None)
+
+            if specific_variables is not None:
+                dialog_variables.extend(specific_variables)
+
+        print('simple_messaging_dialog_support.dialog_variables: 1.3')
+
+        if len(dialog_variables) == 0: # pylint: disable=len-as-condition
+            for variable_key in DialogVariable.objects.order_by().values_list('key', flat=True).distinct():
+                if (variable_key in dialog_variables) is False:
+                    dialog_variables.append(variable_key)
+
+        columns.extend(dialog_variables)
+
+        # Sessions are exported in lookup hash order, so sorting the sources the same way lets parallel
+        # slices be concatenated into the same output a single pass would produce.
+
+        data_sources = sorted(data_sources, key=generate_lookup_hash)
+    elif data_type == 'simple_messaging_dialog_support.dialog_variable_timeline':
+        filename_base = tempfile.gettempdir() + os.path.sep + 'simple_messaging_dialog_support.dialog_variables'
+
+        print('dialog_variable_timeline 1.1')
+
+        columns = [
+            'Destination',
+            'Dialog',
+            'Date Set',
+            'Key',
+            'Value',
+        ]
+    else:
+        return None
 
-                    if sender in source_names:
-                        row = []
+    data_sources = list(data_sources)
 
-                        row.append(fetch_export_identifier(variable.current_sender()))
-                        row.append(variable.dialog_key)
-                        row.append(variable.date_set.astimezone(here_tz).isoformat())
-                        row.append(variable.key)
-                        row.append(variable.value)
+    workers = export_workers()
 
-                        writer.writerow(row)
+    task = (data_type, data_sources, columns, start_time, end_time, resolve_legacy_hashes(data_type, export_hash_map(data_type, data_sources)),)
 
-                    if variable.lookup_hash is None:
-                        variable.lookup_hash = hash_lookup
-                        variable.save()
+    filename, writer = open_export_writer(filename_base, export_format_option(custom_parameters), columns)
 
-        return filename
+    try:
+        if workers > 1 and len(data_sources) > 1:
+            write_export_rows_parallel(writer, task, workers)
+        else:
+            write_export_rows(writer, task)
+    finally:
+        writer.close()
 
-    return None
+    return filename
 
 def simple_data_export_fields(data_type):
     if data_type in ('simple_messaging.conversation_transcripts', 'users_scheduling.link_clicks',):
@@ -284,7 +466,7 @@ def simple_data_export_field_values(data_type, context, extra_fields): # pylint:
 
                     dialogs = []
 
-                    for session in DialogSession.objects.filter(query):
+                    for session in DialogSession.objects.for_destination(participant).filter(query):
                         if session.current_destination() == participant:
                             dialogs.append(session.dialog.script.identifier)
 
@@ -1,19 +1,22 @@
 # pylint: disable=no-member, line-too-long
 
-import importlib
 import json
 import logging
 import traceback
 
-from django.conf import settings
-from django.core.management import call_command
 from django.db.models import Q
 from django.utils import timezone
 
 from django_dialog_engine.models import Dialog, DialogScript
 from simple_messaging.models import OutgoingMessage
 
-from .models import DialogSession, DialogTemplateVariable, LaunchKeyword
+from .dispatch import request_send_flush
+from .hooks import fetch_hooks, fetch_preferred_hooks
+from .keywords import fetch_keyword_index
+from .models import DialogSession
+from .snapshots import prepared_dialog_snapshot
+from .switchboard import default_channel, enabled_channel
+from .template_variables import template_variable_metadata
 
 def process_outgoing_message(outgoing_message, metadata=None): # pylint: disable=too-many-locals, too-many-branches, too-many-statements
     message_content = outgoing_message.current_message()
@@ -25,78 +28,35 @@ def process_outgoing_message(outgoing_message, metadata=None): # pylint: disable
             script = DialogScript.objects.filter(identifier=identifier).first()
 
             if script is not None:
-                for session in DialogSession.objects.filter(finished=None):
-                    if session.current_destination() == outgoing_message.current_destination():
-                        session.finished = timezone.now()
-                        session.save()
+                destination = outgoing_message.current_destination()
 
-                        if session.dialog is not None:
-                            session.dialog.finished = timezone.now()
-                            session.dialog.finish_reason = 'dialog_cancelled'
+                DialogSession.objects.cancel_for_destination(destination, 'dialog_cancelled')
 
-                            session.dialog.save()
+                metadata = template_variable_metadata(script)
 
-                script_def = script.definition
-
-                metadata = {}
-
-                script_labels = script.labels_list()
-
-                template_variables = list(DialogTemplateVariable.objects.filter(script=None))
-                template_variables.extend(script.template_variables.all())
-
-                for variable in template_variables:
-                    variable_value = str(variable.fetch_value())
-
-                    values = variable_value.strip().splitlines()
-
-                    if len(values) == 1:
-                        metadata[variable.key] = variable_value
-                    else:
-                        for raw_value in values:
-                            value_tokens = raw_value.split('|')
-
-                            if len(value_tokens) == 1:
-                                metadata[variable.key] = value_tokens[0]
-                            else:
-                                tag = value_tokens[0]
-
-                                if tag in script_labels:
-                                    metadata[variable.key] = value_tokens[1]
-
-                        if metadata.get(variable.key, None) is None:
-                            value_tokens = values[0].split('|')
-
-                            metadata[variable.key] = value_tokens[-1]
+                snapshot_overrides = {}
 
                 if outgoing_message.message_metadata is not None and outgoing_message.message_metadata != '':
                     try:
                         metadata.update(json.loads(outgoing_message.message_metadata))
 
-                        interrupt_minutes = metadata.get('interrupt_minutes', None)
-                        pause_minutes = metadata.get('pause_minutes', None)
-                        timeout_minutes = metadata.get('timeout_minutes', None)
-
-                        for node in script_def:
-                            if interrupt_minutes is not None and node['type'] == 'time-elapsed-interrupt':
-                                node['type'] = 'pause'
-                                node['duration'] = int(interrupt_minutes * 60)
-
-                            elif pause_minutes is not None and node['type'] == 'pause':
-                                node['duration'] = int(pause_minutes * 60)
-                            elif timeout_minutes is not None and 'timeout' in node:
-                                node['timeout'] = int(timeout_minutes * 60)
-
+                        snapshot_overrides['interrupt_minutes'] = metadata.get('interrupt_minutes', None)
+                        snapshot_overrides['pause_minutes'] = metadata.get('pause_minutes', None)
+                        snapshot_overrides['timeout_minutes'] = metadata.get('timeout_minutes', None)
                     except ValueError:
                         pass
 
+                script_def = prepared_dialog_snapshot(script, **snapshot_overrides)
+
                 dialog = Dialog.objects.create(key=identifier, script=script, dialog_snapshot=script_def, started=timezone.now())
 
                 if metadata is not None:
                     dialog.metadata = metadata
                     dialog.save()
 
-                new_session = DialogSession.objects.create(destination=outgoing_message.current_destination(), dialog=dialog, started=dialog.started, last_updated=dialog.started)
+                # No variables exist for the new session yet, so its snapshot starts out current.
+
+                new_session = DialogSession.objects.create_encrypted(destination=outgoing_message.current_destination(), dialog=dialog, started=dialog.started, last_updated=dialog.started, last_variable_update=dialog.started)
 
                 transmission_metadata = None
 
@@ -112,27 +72,20 @@ def process_outgoing_message(outgoing_message, metadata=None): # pylint: disable
                 if message_channel is not None:
                     new_session.latest_variables['message_channel'] = message_channel
                     new_session.transmission_channel = message_channel
-                    new_session.save()
+                    new_session.save(update_fields=['transmission_channel', 'latest_variables'])
                 else: # Try to be explicit about channel if switchboard is present
-                    try:
-                        from simple_messaging_switchboard.models import Channel # pylint: disable=import-outside-toplevel
-
-                        default_channel = Channel.objects.filter(is_default=True).first()
+                    default_identifier = default_channel()
 
-                        if default_channel is not None:
-                            new_session.latest_variables['message_channel'] = default_channel.identifier
-                            new_session.transmission_channel = default_channel.identifier
-                            new_session.save()
-                    except ImportError:
-                        pass
+                    if default_identifier is not None:
+                        new_session.latest_variables['message_channel'] = default_identifier
+                        new_session.transmission_channel = default_identifier
+                        new_session.save(update_fields=['transmission_channel', 'latest_variables'])
 
                 launch_keyword = transmission_metadata.get('simple_messaging_launch_keyword', None)
 
                 if launch_keyword is not None:
                     new_session.add_variable('simple_messaging_launch_keyword', launch_keyword)
 
-                new_session.encrypt_destination()
-
                 metadata = {
                     'session_id': new_session.pk
                 }
@@ -160,21 +113,99 @@ def process_outgoing_message(outgoing_message, metadata=None): # pylint: disable
 
     return None
 
-def launch_keyword_enabled(sender, keyword):
-    is_enabled = True
+# Per-message memo of (hook, keyword) -> enabled, kept in the shared context so every call made for the same
+# message reuses earlier answers.
 
-    for app in settings.INSTALLED_APPS:
-        try:
-            dialog_module = importlib.import_module('.dialog_api', package=app)
+KEYWORD_ENABLED_MEMO_KEY = '__smds_keyword_enabled'
+
+def memoized_offset(memo, hook, keywords):
+    # Returns (first keyword offset not known to be disabled, whether that keyword is known to be enabled).
+
+    offset = 0
+
+    while offset < len(keywords) and memo.get((hook, keywords[offset],), None) is False:
+        offset += 1
+
+    return offset, (offset < len(keywords) and memo.get((hook, keywords[offset],), None) is True)
+
+def first_enabled_offset(hook_name, hook, sender, keywords, context):
+    memo = context.setdefault(KEYWORD_ENABLED_MEMO_KEY, {})
+
+    start, known_enabled = memoized_offset(memo, hook, keywords)
+
+    if known_enabled:
+        return start
+
+    remaining = keywords[start:]
+
+    if hook_name == 'launch_keywords_enabled':
+        if len(remaining) == 0: # pylint: disable=len-as-condition
+            return None
 
-            if dialog_module.launch_keyword_enabled(sender, keyword) is False:
-                is_enabled = False
-        except ImportError:
-            pass # traceback.print_exc()
-        except AttributeError:
-            pass # traceback.print_exc()
+        enabled = hook(sender, remaining, context)
 
-    return is_enabled
+        if enabled in (None, False,):
+            offset = len(remaining)
+        elif enabled in remaining:
+            offset = remaining.index(enabled)
+
+            memo[(hook, enabled,)] = True
+        else:
+            logging.getLogger().error('%s.launch_keywords_enabled returned %s, which is not one of the candidates - treating as no keyword enabled.', hook.__module__, enabled)
+
+            return None
+
+        for keyword in remaining[:offset]:
+            memo[(hook, keyword,)] = False
+
+        return None if offset == len(remaining) else (start + offset)
+
+    for offset, keyword in enumerate(remaining):
+        if ((hook, keyword,) in memo) is False:
+            memo[(hook, keyword,)] = hook(sender, keyword) is not False
+
+        if memo[(hook, keyword,)]:
+            return start + offset
+
+    return None
+
+def first_enabled_keyword(sender, keywords, context=None):
+    # Apps may implement launch_keywords_enabled(sender, keywords, context) to vet the ordered candidates in one
+    # call and return the first enabled keyword (or None). Apps that only provide launch_keyword_enabled(sender,
+    # keyword) are asked one keyword at a time. context is shared across every call made for the same message,
+    # and each hook's answer for a keyword is memoized in it.
+
+    if context is None:
+        context = {}
+
+    keywords = list(keywords)
+
+    hooks = fetch_preferred_hooks(('launch_keywords_enabled', 'launch_keyword_enabled',))
+
+    start = 0
+
+    while start < len(keywords):
+        agreed = True
+
+        for hook_name, hook in hooks:
+            offset = first_enabled_offset(hook_name, hook, sender, keywords[start:], context)
+
+            if offset is None:
+                return None
+
+            if offset > 0: # Skip ahead and ask every app about the new candidate
+                start += offset
+                agreed = False
+
+                break
+
+        if agreed:
+            return keywords[start]
+
+    return None
+
+def launch_keyword_enabled(sender, keyword):
+    return first_enabled_keyword(sender, [keyword]) is not None
 
 def process_incoming_message(incoming_message): # pylint: disable=too-many-locals, too-many-branches, too-many-statements
     sender = incoming_message.current_sender()
@@ -188,19 +219,7 @@ def process_incoming_message(incoming_message): # pylint: disable=too-many-local
     except json.JSONDecodeError:
         pass
 
-    message_channel = None
-
-    try:
-        from simple_messaging_switchboard.models import Channel # pylint: disable=import-outside-toplevel
-
-        channel_name = transmission_metadata.get('message_channel', None)
-
-        channel = Channel.objects.filter(identifier=channel_name, is_enabled=True).first()
-
-        if channel is not None:
-            message_channel = channel.identifier
-    except ImportError:
-        pass
+    message_channel = enabled_channel(transmission_metadata.get('message_channel', None))
 
     query = Q(transmission_channel=message_channel)
 
@@ -209,7 +228,7 @@ def process_incoming_message(incoming_message): # pylint: disable=too-many-local
 
     processed = False
 
-    for session in DialogSession.objects.filter(finished=None).filter(query):
+    for session in DialogSession.objects.for_destination(sender).filter(finished=None).filter(query):
         if session.current_destination() == sender:
             if processed is False:
                 if message_channel is not None: # Found channel for session
@@ -226,40 +245,23 @@ def process_incoming_message(incoming_message): # pylint: disable=too-many-local
     if processed is False:
         message = incoming_message.message.strip()
 
-        for app in settings.INSTALLED_APPS:
-            try:
-                response_module = importlib.import_module('.simple_messaging_api', package=app)
-
-                if response_module.disable_keywords_for_message(incoming_message):
-                    return
-            except ImportError:
-                pass
-            except AttributeError:
-                pass
+        for disable_keywords_for_message in fetch_hooks('disable_keywords_for_message', module_name='simple_messaging_api'):
+            if disable_keywords_for_message(incoming_message):
+                return
 
         match = None
 
-        for keyword in LaunchKeyword.objects.exclude(keyword='*').order_by('-priority'):
-            if keyword.case_sensitive:
-                if keyword.keyword == message:
-                    if launch_keyword_enabled(sender, keyword):
-                        match = keyword.dialog_script
+        keyword_index = fetch_keyword_index()
 
-                        break
-            else:
-                if keyword.keyword.lower() == message.lower():
-                    if launch_keyword_enabled(sender, keyword):
-                        match = keyword.dialog_script
+        keyword_context = {}
 
-                        break
+        keyword = first_enabled_keyword(sender, keyword_index.candidates(message), keyword_context)
 
-        if match is None:
-            for keyword in LaunchKeyword.objects.filter(keyword='*').order_by('-priority'):
-                if keyword is not None:
-                    if launch_keyword_enabled(sender, keyword):
-                        match = keyword.dialog_script
+        if keyword is None:
+            keyword = first_enabled_keyword(sender, keyword_index.catch_all, keyword_context)
 
-                        break
+        if keyword is not None:
+            match = keyword.dialog_script
 
         if match is not None:
             transmission_metadata = {}
@@ -276,7 +278,7 @@ def process_incoming_message(incoming_message): # pylint: disable=too-many-local
             outgoing = OutgoingMessage.objects.create(destination=sender, send_date=timezone.now(), message=dialog_message, transmission_metadata=json.dumps(transmission_metadata, indent=2))
             outgoing.encrypt_destination()
 
-            call_command('simple_messaging_send_pending_messages', _qs_context=False)
+            request_send_flush()
 
 def simple_messaging_record_response(post_request): # pylint: disable=invalid-name, unused-argument
     return True
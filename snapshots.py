@@ -0,0 +1,20 @@
+# pylint: disable=line-too-long
+
+def prepared_dialog_snapshot(script, interrupt_minutes=None, pause_minutes=None, timeout_minutes=None):
+    definition = script.definition
+
+    if interrupt_minutes is None and pause_minutes is None and timeout_minutes is None:
+        return definition # Nothing to apply - used as-is, as before
+
+    # The definition was just loaded with the script, so overrides are applied to it in place - a single walk
+    # without copying.
+
+    for node in definition:
+        if interrupt_minutes is not None and node['type'] == 'time-elapsed-interrupt':
+            node.update({'type': 'pause', 'duration': int(interrupt_minutes * 60)})
+        elif pause_minutes is not None and node['type'] == 'pause':
+            node['duration'] = int(pause_minutes * 60)
+        elif timeout_minutes is not None and 'timeout' in node:
+            node['timeout'] = int(timeout_minutes * 60)
+
+    return definition
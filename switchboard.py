@@ -0,0 +1,65 @@
+# pylint: disable=line-too-long, no-member
+
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+Channel = None # pylint: disable=invalid-name
+
+if apps.is_installed('simple_messaging_switchboard'):
+    try:
+        from simple_messaging_switchboard.models import Channel # pylint: disable=ungrouped-imports
+    except ImportError:
+        pass
+
+# Resolved channel identifiers (or None) keyed by lookup. Cleared on any Channel change, with a TTL bounding
+# staleness in other processes.
+
+CHANNEL_CACHE = {}
+
+def switchboard_installed():
+    return Channel is not None
+
+def fetch_cached_channel(cache_key, query):
+    if Channel is None:
+        return None
+
+    now = time.monotonic()
+
+    cached = CHANNEL_CACHE.get(cache_key, None)
+
+    if cached is not None and (now - cached[1]) < getattr(settings, 'SIMPLE_MESSAGING_DIALOG_CHANNEL_CACHE_TTL', 60):
+        return cached[0]
+
+    channel = Channel.objects.filter(**query).first()
+
+    identifier = None
+
+    if channel is not None:
+        identifier = channel.identifier
+
+    CHANNEL_CACHE[cache_key] = (identifier, now,)
+
+    return identifier
+
+def enabled_channel(identifier):
+    return fetch_cached_channel(('enabled', identifier,), {'identifier': identifier, 'is_enabled': True})
+
+def default_channel(require_enabled=False):
+    query = {
+        'is_default': True,
+    }
+
+    if require_enabled:
+        query['is_enabled'] = True
+
+    return fetch_cached_channel(('default', require_enabled,), query)
+
+def clear_channel_cache(sender, **kwargs): # pylint: disable=unused-argument
+    CHANNEL_CACHE.clear()
+
+if Channel is not None:
+    post_save.connect(clear_channel_cache, sender=Channel)
+    post_delete.connect(clear_channel_cache, sender=Channel)
@@ -0,0 +1,74 @@
+# pylint: disable=line-too-long, no-member
+
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from django_dialog_engine.models import DialogScript
+
+from .hooks import fetch_hooks
+from .models import DialogSession, DialogTemplateVariable
+
+# Resolved (key, value) pairs keyed by (script ID, script labels). Cleared by the receivers below on any
+# template variable or script change, with a TTL bounding staleness in other processes.
+
+TEMPLATE_VARIABLE_CACHE = {}
+
+def fetch_template_variables(script):
+    script_pk = None
+    script_labels = []
+
+    if script is not None:
+        script_pk = script.pk
+        script_labels = script.labels_list()
+
+    cache_key = (script_pk, tuple(script_labels),)
+
+    now = time.monotonic()
+
+    cached = TEMPLATE_VARIABLE_CACHE.get(cache_key, None)
+
+    if cached is not None and (now - cached[1]) < getattr(settings, 'SIMPLE_MESSAGING_DIALOG_TEMPLATE_CACHE_TTL', 60):
+        return cached[0]
+
+    template_variables = list(DialogTemplateVariable.objects.filter(script=None))
+
+    if script is not None:
+        template_variables.extend(script.template_variables.all())
+
+    resolved = tuple((variable.key, variable.resolve_value(script_labels),) for variable in template_variables)
+
+    TEMPLATE_VARIABLE_CACHE[cache_key] = (resolved, now,)
+
+    return resolved
+
+def template_variable_metadata(script):
+    metadata = {}
+
+    for key, value in fetch_template_variables(script):
+        metadata[key] = value
+
+    return metadata
+
+@receiver(post_save, sender=DialogTemplateVariable)
+@receiver(post_delete, sender=DialogTemplateVariable)
+@receiver(post_save, sender=DialogScript)
+@receiver(post_delete, sender=DialogScript)
+def clear_template_variable_cache(sender, **kwargs): # pylint: disable=unused-argument
+    TEMPLATE_VARIABLE_CACHE.clear()
+
+@receiver(post_save, sender=DialogSession)
+def update_dialog_variables(sender, instance, created, raw, using, update_fields, **kwargs): # pylint: disable=too-many-arguments, unused-argument
+    if created is True and raw is False:
+        for key, value in fetch_template_variables(instance.dialog.script):
+            if (key in instance.dialog.metadata) is False:
+                instance.dialog.metadata[key] = value
+
+        for fetch_dialog_metadata in fetch_hooks('fetch_dialog_metadata'):
+            updates = fetch_dialog_metadata(instance.current_destination(), instance.dialog)
+
+            instance.dialog.metadata.update(updates)
+
+        instance.dialog.save()
@@ -1,3 +1,72 @@
-# from django.test import TestCase
+# pylint: disable=line-too-long
 
-# Create your tests here.
+from unittest import mock
+
+from django.core.exceptions import ValidationError
+from django.test import SimpleTestCase
+
+from .keywords import LaunchKeywordIndex
+from .models import LaunchKeyword
+from .simple_messaging_api import first_enabled_keyword
+
+class LaunchKeywordIndexTestCase(SimpleTestCase):
+    def build_index(self, *keywords):
+        return LaunchKeywordIndex([LaunchKeyword(pk=(index + 1), keyword=keyword, match_mode=match_mode, case_sensitive=case_sensitive) for index, (keyword, match_mode, case_sensitive) in enumerate(keywords)])
+
+    def test_match_modes(self):
+        index = self.build_index(('start', 'exact', False), ('hel', 'prefix', False), ('help', 'contains', False), ('stop', 'token', False), (r'^join\s+\d+$', 'regex', False))
+
+        self.assertEqual(['start'], [keyword.keyword for keyword in index.candidates('START')])
+        self.assertEqual(['hel', 'help'], [keyword.keyword for keyword in index.candidates('Help me')])
+        self.assertEqual(['help'], [keyword.keyword for keyword in index.candidates('please help')])
+        self.assertEqual(['stop'], [keyword.keyword for keyword in index.candidates('stop it')])
+        self.assertEqual([], index.candidates('nonstop'))
+        self.assertEqual([r'^join\s+\d+$'], [keyword.keyword for keyword in index.candidates('join 12')])
+
+    def test_uncombinable_patterns(self):
+        index = self.build_index(('(?i)stop', 'regex', True), ('(?P<x>go)', 'regex', False), ('(?P<x>run)', 'regex', False), (r'(a)\1', 'regex', False), ('[', 'regex', False))
+
+        self.assertEqual(['(?i)stop'], [keyword.keyword for keyword in index.candidates('STOP now')])
+        self.assertEqual(['(?P<x>go)'], [keyword.keyword for keyword in index.candidates('go')])
+        self.assertEqual(['(?P<x>run)'], [keyword.keyword for keyword in index.candidates('run')])
+        self.assertEqual([r'(a)\1'], [keyword.keyword for keyword in index.candidates('aa')])
+        self.assertEqual([], index.candidates('ab'))
+
+    def test_clean_rejects_uncombinable(self):
+        for pattern in ('(?i)stop', '(?P<x>go)', r'(a)\1', '(?(1)a|b)', '['):
+            with self.assertRaises(ValidationError):
+                LaunchKeyword(keyword=pattern, match_mode='regex').clean()
+
+        LaunchKeyword(keyword=r'(?i:stop)|[\1]', match_mode='regex').clean()
+
+class FirstEnabledKeywordTestCase(SimpleTestCase):
+    def test_memoized_hooks(self):
+        keywords = [LaunchKeyword(pk=(index + 1), keyword=keyword) for index, keyword in enumerate(('a', 'b', 'c',))]
+
+        calls = []
+
+        def launch_keywords_enabled(sender, candidates, context): # pylint: disable=unused-argument
+            calls.append(('batched', [keyword.keyword for keyword in candidates],))
+
+            return candidates[-1]
+
+        def launch_keyword_enabled(sender, keyword):
+            calls.append(('single', keyword.keyword,))
+
+            return sender == keyword.keyword
+
+        hooks = [('launch_keywords_enabled', launch_keywords_enabled,), ('launch_keyword_enabled', launch_keyword_enabled,)]
+
+        with mock.patch('simple_messaging_dialog_support.simple_messaging_api.fetch_preferred_hooks', return_value=hooks):
+            context = {}
+
+            self.assertEqual(keywords[2], first_enabled_keyword('c', keywords, context))
+            self.assertEqual(keywords[2], first_enabled_keyword('c', keywords[1:], context))
+
+        self.assertEqual([('batched', ['a', 'b', 'c'],), ('single', 'c',)], calls)
+
+    def test_invalid_batched_result(self):
+        hooks = [('launch_keywords_enabled', lambda sender, candidates, context: 'unknown',)]
+
+        with mock.patch('simple_messaging_dialog_support.simple_messaging_api.fetch_preferred_hooks', return_value=hooks):
+            self.assertIsNone(first_enabled_keyword('a', [LaunchKeyword(pk=1, keyword='a')]))